@@ -0,0 +1,103 @@
+import argparse
+import glob
+import json
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import utils
+
+# Performance report built from the metrics.jsonl of Brownaming runs: one line
+# per run, or one line per step with --steps.
+# Usage: python benchmark/report.py [RUN_ID ...] [--steps]
+
+def read_metrics(path):
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+def throughput(residues, seconds):
+    return residues / seconds if seconds > 0 else 0.0
+
+def cpu_efficiency(record):
+    # Share of the requested cores DIAMOND kept busy
+    wall = record.get('diamond_wall', 0.0)
+    return record.get('diamond_cpu', 0.0) / (wall * record['threads']) if wall > 0 else 0.0
+
+def print_table(header, rows):
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+def step_rows(records):
+    rows = []
+    for r in records:
+        rows.append([
+            r['run_id'], r['step'], r['taxon_id'], r['mode'], r['nb_query'], r['residues'], r['dbsize'],
+            r.get('taxonlist_size', ''), r.get('hits', ''),
+            f"{r['time'] * 60:.1f}", f"{r.get('diamond_wall', 0.0):.1f}", f"{cpu_efficiency(r):.0%}",
+            f"{r.get('diamond_peak_rss_mb', 0.0):.0f}",
+            f"{r.get('parse_time', 0.0):.2f}", f"{r.get('selection_time', 0.0):.2f}",
+            f"{throughput(r['residues'], r.get('diamond_wall', 0.0)):.0f}"
+        ])
+    return rows
+
+def run_rows(runs):
+    rows = []
+    for run_id, records in runs.items():
+        wall = sum(r.get('diamond_wall', 0.0) for r in records)
+        cpu = sum(r.get('diamond_cpu', 0.0) for r in records)
+        core_seconds = sum(r.get('diamond_wall', 0.0) * r['threads'] for r in records)
+        step_time = sum(r['time'] * 60 for r in records)
+        rows.append([
+            run_id, len(records), sum(r.get('diamond_runs', 0) for r in records),
+            f"{step_time / 60:.1f}", f"{wall / 60:.1f}", f"{cpu / core_seconds:.0%}" if core_seconds else "-",
+            f"{max((r.get('diamond_peak_rss_mb', 0.0) for r in records), default=0):.0f}",
+            f"{sum(r.get('parse_time', 0.0) for r in records):.1f}",
+            f"{sum(r.get('selection_time', 0.0) for r in records):.1f}",
+            f"{1 - wall / step_time:.0%}" if step_time else "-"
+        ])
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Brownaming performance report from runs/*/metrics.jsonl")
+    parser.add_argument('run_ids', nargs='*', help='Runs to report (default: all runs with metrics)')
+    parser.add_argument('--steps', action='store_true', help='One line per step instead of one line per run')
+    args = parser.parse_args()
+
+    runs_dir = os.path.join(utils.script_dir(), 'runs')
+    if args.run_ids:
+        paths = [os.path.join(runs_dir, run_id, 'metrics.jsonl') for run_id in args.run_ids]
+    else:
+        paths = sorted(glob.glob(os.path.join(runs_dir, '*', 'metrics.jsonl')))
+    runs = {}
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"[WARNING] {path} not found")
+            continue
+        records = read_metrics(path)
+        if records:
+            runs[records[0]['run_id']] = records
+    if not runs:
+        print("[ERROR] No metrics found. Run some Brownaming analyses first!")
+        exit(1)
+
+    if args.steps:
+        print_table(
+            ['run', 'step', 'taxid', 'mode', 'queries', 'residues', 'dbsize', 'taxa', 'hits',
+             'step_s', 'diamond_s', 'cpu_eff', 'rss_mb', 'parse_s', 'select_s', 'residues/s'],
+            step_rows([r for records in runs.values() for r in records])
+        )
+    else:
+        print_table(
+            ['run', 'steps', 'diamond_runs', 'total_min', 'diamond_min', 'cpu_eff', 'peak_rss_mb',
+             'parse_s', 'select_s', 'overhead'],
+            run_rows(runs)
+        )
+
+if __name__ == "__main__":
+    main()
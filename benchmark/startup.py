@@ -0,0 +1,64 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Startup time of the command-line entry points, and the heavy libraries loaded
+# by importing the Brownaming modules. Exits with 1 when a command is slower
+# than --max-seconds or when a heavy library is imported at module load, so it
+# can guard against regressions in CI.
+# Usage: python benchmark/startup.py [--repeat N] [--max-seconds S]
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+COMMANDS = [
+    ['main.py', '--help'],
+    ['main.py', 'batch', '--help'],
+    ['main.py', 'shard', '--help'],
+    ['main.py', '--bad-argument'],
+]
+MODULES = ['utils', 'homology', 'excel', 'stats', 'hit_cache', 'scheduler', 'sharding', 'shared_steps']
+# Only loaded in the phase that needs them
+HEAVY_LIBRARIES = ['numpy', 'pandas', 'matplotlib', 'openpyxl', 'Bio', 'requests', 'sklearn', 'pyarrow']
+
+def time_command(command, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *command], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def heavy_imports():
+    code = (
+        f"import sys; import {', '.join(MODULES)}; "
+        f"print(' '.join(m for m in {HEAVY_LIBRARIES!r} if m in sys.modules))"
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the Brownaming entry points")
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each command, the median is reported (default: 5)')
+    parser.add_argument('--max-seconds', type=float, default=1.0, help='Fail when a command takes longer (default: 1.0)')
+    args = parser.parse_args()
+
+    failed = False
+    for command in COMMANDS:
+        seconds = time_command(command, args.repeat)
+        status = "ok" if seconds <= args.max_seconds else "SLOW"
+        failed |= seconds > args.max_seconds
+        print(f"{' '.join(command):<28} {seconds:6.3f} s  {status}")
+
+    loaded = heavy_imports()
+    if loaded:
+        failed = True
+        print(f"[ERROR] Imported at module load: {', '.join(loaded)}")
+    else:
+        print(f"No heavy library imported by {', '.join(MODULES)}")
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
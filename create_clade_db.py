@@ -0,0 +1,123 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import utils
+
+# Builds clade-specific DIAMOND databases (e.g. major phyla or frequently
+# annotated genera) from uniprot_all.fasta in a single pass. homology.run_diamond
+# then searches the smallest of them that covers a step instead of the whole
+# uniprot_all.dmnd. Usage: python create_clade_db.py TAXID[,TAXID...] ...
+
+CONFIG = {}
+local_db_path = None
+config_file = os.path.join(os.path.dirname(__file__), "config.json")
+if os.path.exists(config_file):
+    with open(config_file, "r") as f:
+        CONFIG = json.load(f)
+    local_db_path = CONFIG.get("local_db_path", None)
+
+if not local_db_path:
+    print("[ERROR] 'local_db_path' not set in config.json")
+    exit()
+
+clades = []
+for arg in sys.argv[1:]:
+    for taxid in arg.split(","):
+        if taxid.strip():
+            clades.append(int(taxid))
+if not clades:
+    clades = [int(taxid) for taxid in CONFIG.get("clade_dbs", [])]
+if not clades:
+    print("[INFO] No clade database requested")
+    exit()
+
+utils.LOCAL_DB_PATH = local_db_path
+utils.PARENT = utils.set_parent_dict()
+if not utils.PARENT:
+    print("[ERROR] Taxonomy helpers not found. Run create_taxonomy_json.py first")
+    exit()
+
+all_fasta = os.path.join(local_db_path, "fasta", "uniprot_all.fasta")
+all_dmnd = os.path.join(local_db_path, "diamond", "uniprot_all.dmnd")
+taxonmap = os.path.join(local_db_path, "mapping", "taxonmap.tsv")
+nodes = os.path.join(local_db_path, "taxonomy", "nodes.dmp")
+names = os.path.join(local_db_path, "taxonomy", "names.dmp")
+clade_dir = os.path.join(local_db_path, "diamond", "clades")
+os.makedirs(clade_dir, exist_ok=True)
+
+# Letters of the full database, passed as --dbsize so that e-values computed
+# against a clade database are the same as against uniprot_all.dmnd
+dbinfo = subprocess.run(["diamond", "dbinfo", "-d", all_dmnd], capture_output=True, text=True, check=True).stdout
+match = re.search(r"Letters\s+(\d+)", dbinfo)
+full_letters = int(match.group(1)) if match else None
+
+clade_set = set(clades)
+memo = {}
+
+def clades_of(taxid):
+    if taxid not in memo:
+        found = []
+        curr = taxid
+        while curr is not None:
+            if curr in clade_set:
+                found.append(curr)
+            parent = utils.PARENT.get(str(curr))
+            if parent == curr:
+                break
+            curr = parent
+        memo[taxid] = tuple(found)
+    return memo[taxid]
+
+ox_re = re.compile(rb" OX=(\d+)")
+handles = {taxid: open(os.path.join(clade_dir, f"{taxid}.fasta"), "wb") for taxid in clades}
+counts = {taxid: [0, 0] for taxid in clades}
+print(f"[INFO] Extract sequences of {len(clades)} clades from {all_fasta}")
+with open(all_fasta, "rb") as f:
+    targets = ()
+    for line in f:
+        if line.startswith(b">"):
+            match = ox_re.search(line)
+            targets = clades_of(int(match.group(1))) if match else ()
+            for taxid in targets:
+                counts[taxid][0] += 1
+        elif targets:
+            for taxid in targets:
+                counts[taxid][1] += len(line) - 1
+        for taxid in targets:
+            handles[taxid].write(line)
+for handle in handles.values():
+    handle.close()
+
+manifest_path = os.path.join(clade_dir, "manifest.json")
+manifest = {}
+if os.path.exists(manifest_path):
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+for taxid in clades:
+    clade_fasta = os.path.join(clade_dir, f"{taxid}.fasta")
+    sequences, letters = counts[taxid]
+    if sequences == 0:
+        print(f"[WARNING] No sequence found for clade {taxid}, skipped")
+        os.remove(clade_fasta)
+        continue
+    print(f"[INFO] Make diamond db for clade {taxid} ({sequences} sequences)")
+    building = os.path.join(clade_dir, f"{taxid}.building")
+    subprocess.run([
+        "diamond", "makedb", "-p", str(os.cpu_count() or 1),
+        "-d", building, "--in", clade_fasta,
+        "--taxonmap", taxonmap, "--taxonnodes", nodes, "--taxonnames", names
+    ], check=True)
+    os.replace(building + ".dmnd", os.path.join(clade_dir, f"{taxid}.dmnd"))
+    os.remove(clade_fasta)
+    manifest[str(taxid)] = {
+        "dmnd": f"{taxid}.dmnd",
+        "sequences": sequences,
+        "letters": letters,
+        "full_letters": full_letters
+    }
+
+with open(manifest_path, "w") as f:
+    json.dump(manifest, f, indent=4)
+print(f"[INFO] {len(manifest)} clade databases available in {clade_dir}")
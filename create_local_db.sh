@@ -3,23 +3,43 @@ set -euo pipefail
 
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 CONFIG_FILE="$SCRIPT_DIR/config.json"
+UNIPROT_URL="https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/complete"
+TAXDUMP_URL="https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/new_taxdump/new_taxdump.tar.gz"
 
 # Command-line argument handling
 REFRESH_MODE=false
+CLEAN_MODE=false
+CLADES=""
 for arg in "$@"; do
   case $arg in
     --refresh)
       REFRESH_MODE=true
-      echo "[INFO] Refresh mode enabled - reinstalling database"
+      echo "[INFO] Refresh mode enabled - steps whose inputs did not change are skipped"
+      shift
+      ;;
+    --clean)
+      CLEAN_MODE=true
+      shift
+      ;;
+    --clades=*)
+      CLADES="${arg#*=}"
       shift
       ;;
   esac
 done
 
-for bin in jq curl diamond awk gunzip; do
+for bin in jq curl diamond awk gunzip md5sum python; do
   command -v "$bin" >/dev/null || { echo "Missing dependency: $bin" >&2; exit 1; }
 done
 
+# pigz decompresses with separate read, write and check threads
+if command -v pigz >/dev/null; then
+  DECOMPRESS="pigz -dc"
+else
+  echo "[WARNING] pigz not found, decompressing with gunzip"
+  DECOMPRESS="gunzip -c"
+fi
+
 if [[ ! -f "$CONFIG_FILE" ]]; then
   echo "Config file not found: $CONFIG_FILE" >&2
   exit 1
@@ -31,112 +51,246 @@ if [[ -z "$LOCAL_DB_PATH" || "$LOCAL_DB_PATH" == "null" ]]; then
     exit 1
 fi
 
-# Remove old database if refresh mode is enabled
-if [[ "$REFRESH_MODE" == true && -d "$LOCAL_DB_PATH" ]]; then
+# Remove old database if clean mode is enabled
+if [[ "$CLEAN_MODE" == true && -d "$LOCAL_DB_PATH" ]]; then
     echo "[INFO] Removing existing database at $LOCAL_DB_PATH"
     rm -rf "$LOCAL_DB_PATH"
 fi
 
 mkdir -p "${LOCAL_DB_PATH}"/{fasta,taxonomy,mapping,diamond}
 
-echo "[INFO] Download Swiss-Prot"
-uniprot_sprot_file="${LOCAL_DB_PATH}/fasta/uniprot_sprot.fasta"
-curl -L --fail --retry 3 https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_sprot.fasta.gz \
-  | gunzip -c > $uniprot_sprot_file
+# Release manifest: the UniProt release, the checksums of the downloads and,
+# for every step, a key made of its inputs. A step is skipped when its key is
+# unchanged and its outputs exist, so a refresh or a re-run after a failure
+# only redoes what changed.
+MANIFEST="${LOCAL_DB_PATH}/release.json"
+[[ -s "$MANIFEST" ]] || echo '{"steps": {}}' > "$MANIFEST"
 
-echo "[INFO] Download TrEMBL (~1h)"
-uniprot_all_file="${LOCAL_DB_PATH}/fasta/uniprot_all.fasta"
-curl -L --fail --retry 3 https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_trembl.fasta.gz \
-  | gunzip -c > $uniprot_all_file
+manifest_get() {
+  jq -r --arg path "$1" 'getpath($path | split(".")) // ""' "$MANIFEST"
+}
 
-echo "[INFO] Concatenate"
-cat "${LOCAL_DB_PATH}/fasta/uniprot_sprot.fasta" >> "${LOCAL_DB_PATH}/fasta/uniprot_all.fasta"
+manifest_set() {
+  jq --arg path "$1" --arg value "$2" 'setpath($path | split("."); $value)' "$MANIFEST" > "${MANIFEST}.tmp" \
+    && mv "${MANIFEST}.tmp" "$MANIFEST"
+}
 
-echo "[INFO] Build taxonmap.tsv"
-taxonmap_file="${LOCAL_DB_PATH}/mapping/taxonmap.tsv"
-if [ -s "$taxonmap_file" ]; then
-    echo "[INFO] File exists and is non‑empty, skipping."
+step_done() {
+  local step=$1 key=$2
+  shift 2
+  [[ "$(manifest_get "steps.${step}.key")" == "$key" ]] || return 1
+  for output in "$@"; do
+    [[ -s "$output" ]] || return 1
+  done
+  echo "[INFO] Inputs of step '$step' unchanged, skipped"
+}
+
+step_finished() {
+  manifest_set "steps.$1.key" "$2"
+  manifest_set "steps.$1.date" "$(date -u +%Y-%m-%dT%H:%M:%SZ)"
+}
+
+key_of() {
+  printf '%s\n' "$@" | md5sum | cut -c1-16
+}
+
+# ETag, size and date of a remote file, empty when the server is unreachable
+remote_fingerprint() {
+  local headers
+  headers=$(curl -sIL --fail --retry 3 "$1" | tr -d '\r' | grep -iE '^(etag|last-modified|content-length):' | sort) || true
+  [[ -n "$headers" ]] && key_of "$headers" || true
+}
+
+# MD5 of a UniProt file as listed in the RELEASE.metalink of the release
+metalink_md5() {
+  awk -v file="$1" '
+    index($0, "name=\"" file "\"") { found = 1 }
+    found && match($0, /<hash type="md5">[0-9a-fA-F]+/) { print substr($0, RSTART + 17, RLENGTH - 17); exit }
+  ' "${LOCAL_DB_PATH}/fasta/RELEASE.metalink" 2>/dev/null || true
+}
+
+# Streams a gzip file through the decompressor, keeping the compressed copy
+# only until its checksum is checked against the metalink
+download_uniprot() {
+  local name=$1 out=$2
+  local gz="${LOCAL_DB_PATH}/fasta/${name}.fasta.gz"
+  curl -sS -L --fail --retry 3 "${UNIPROT_URL}/${name}.fasta.gz" | tee "$gz" | $DECOMPRESS > "$out"
+  local md5 expected
+  md5=$(md5sum "$gz" | cut -d' ' -f1)
+  expected=$(metalink_md5 "${name}.fasta.gz")
+  rm -f "$gz"
+  if [[ -n "$expected" && "$md5" != "$expected" ]]; then
+    echo "Checksum mismatch for ${name}.fasta.gz ($md5, expected $expected)" >&2
+    return 1
+  fi
+  echo "$md5" > "${out}.md5"
+}
+
+echo "[INFO] Check UniProt release"
+uniprot_release=$(curl -sL --fail --retry 3 "${UNIPROT_URL}/reldate.txt" \
+  | grep -oE 'Release [0-9]+_[0-9]+' | head -n1 | cut -d' ' -f2 || true)
+sprot_remote=$(remote_fingerprint "${UNIPROT_URL}/uniprot_sprot.fasta.gz")
+trembl_remote=$(remote_fingerprint "${UNIPROT_URL}/uniprot_trembl.fasta.gz")
+if [[ -z "$uniprot_release" || -z "$sprot_remote" || -z "$trembl_remote" ]]; then
+  # Offline: keep the release already recorded, if any
+  uniprot_key=$(manifest_get "steps.uniprot.key")
+  echo "[WARNING] UniProt release could not be checked, using the recorded one ($(manifest_get uniprot_release))"
 else
-  printf "accession\taccession.version\ttaxid\tgi\n" > $taxonmap_file
-  awk -v OFS='\t' '
-    /^>/{
-      acc=""; tax="";
-      split($1,a,"|"); if (length(a)>=2) acc=a[2];
-      if (match($0,/OX=([0-9]+)/,m)) tax=m[1];
-      if (acc!="" && tax!="") printf "%s\t%s\t%s\t0\n", acc, acc, tax;
-    }
-  ' "${LOCAL_DB_PATH}/fasta/uniprot_all.fasta" >> $taxonmap_file
+  uniprot_key=$(key_of "$uniprot_release" "$sprot_remote" "$trembl_remote")
+  echo "[INFO] UniProt release $uniprot_release"
 fi
 
-lines=$(($(wc -l < $taxonmap_file) - 1))
-if (( lines == 0 )); then
-  echo "Empty taxonmap.tsv (no headers parsed)" >&2
-  exit 1
+uniprot_sprot_file="${LOCAL_DB_PATH}/fasta/uniprot_sprot.fasta"
+uniprot_all_file="${LOCAL_DB_PATH}/fasta/uniprot_all.fasta"
+if ! step_done uniprot "$uniprot_key" "$uniprot_sprot_file" "$uniprot_all_file"; then
+  echo "[INFO] Download Swiss-Prot and TrEMBL (~1h)"
+  curl -sS -L --fail --retry 3 -o "${LOCAL_DB_PATH}/fasta/RELEASE.metalink" "${UNIPROT_URL}/RELEASE.metalink" || true
+  download_uniprot uniprot_sprot "${uniprot_sprot_file}.building" &
+  sprot_pid=$!
+  download_uniprot uniprot_trembl "${uniprot_all_file}.building" &
+  trembl_pid=$!
+  wait $sprot_pid
+  wait $trembl_pid
+
+  echo "[INFO] Concatenate"
+  cat "${uniprot_sprot_file}.building" >> "${uniprot_all_file}.building"
+  mv -f "${uniprot_sprot_file}.building" "$uniprot_sprot_file"
+  mv -f "${uniprot_all_file}.building" "$uniprot_all_file"
+  manifest_set uniprot_release "$uniprot_release"
+  manifest_set checksums.uniprot_sprot "$(cat "${uniprot_sprot_file}.building.md5")"
+  manifest_set checksums.uniprot_trembl "$(cat "${uniprot_all_file}.building.md5")"
+  rm -f "${uniprot_sprot_file}.building.md5" "${uniprot_all_file}.building.md5"
+  uniprot_key=${uniprot_key:-$(key_of "$(manifest_get checksums.uniprot_sprot)" "$(manifest_get checksums.uniprot_trembl)")}
+  step_finished uniprot "$uniprot_key"
+fi
+
+taxonmap_file="${LOCAL_DB_PATH}/mapping/taxonmap.tsv"
+taxon_counts_file="${LOCAL_DB_PATH}/mapping/taxon_counts.tsv"
+headers_file="${LOCAL_DB_PATH}/mapping/headers.tsv"
+if ! step_done headers "$uniprot_key" "$taxonmap_file" "$taxon_counts_file" "$headers_file"; then
+  echo "[INFO] Build taxonmap.tsv, per-taxon counts and header metadata"
+  python "${SCRIPT_DIR}/extract_headers.py" "$uniprot_all_file" "${LOCAL_DB_PATH}/mapping" --jobs "$(nproc)"
+  lines=$(($(wc -l < $taxonmap_file) - 1))
+  if (( lines == 0 )); then
+    echo "Empty taxonmap.tsv (no headers parsed)" >&2
+    exit 1
+  fi
+  step_finished headers "$uniprot_key"
 fi
 
-echo "[INFO] Download taxonomy dump"
 nodes="${LOCAL_DB_PATH}/taxonomy/nodes.dmp"
 names="${LOCAL_DB_PATH}/taxonomy/names.dmp"
-curl -L --fail --retry 3 -o "${LOCAL_DB_PATH}/taxonomy/taxdump.tar.gz" \
-  https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/new_taxdump/new_taxdump.tar.gz
-tar -C "${LOCAL_DB_PATH}/taxonomy" -xzf "${LOCAL_DB_PATH}/taxonomy/taxdump.tar.gz" names.dmp nodes.dmp
+taxdump_md5=$(curl -sL --fail --retry 3 "${TAXDUMP_URL}.md5" | cut -d' ' -f1 || true)
+taxonomy_key=${taxdump_md5:-$(manifest_get steps.taxonomy.key)}
+if ! step_done taxonomy "$taxonomy_key" "$nodes" "$names"; then
+  echo "[INFO] Download taxonomy dump"
+  curl -L --fail --retry 3 -o "${LOCAL_DB_PATH}/taxonomy/taxdump.tar.gz" "$TAXDUMP_URL"
+  md5=$(md5sum "${LOCAL_DB_PATH}/taxonomy/taxdump.tar.gz" | cut -d' ' -f1)
+  if [[ -n "$taxdump_md5" && "$md5" != "$taxdump_md5" ]]; then
+    echo "Checksum mismatch for new_taxdump.tar.gz ($md5, expected $taxdump_md5)" >&2
+    exit 1
+  fi
+  tar -C "${LOCAL_DB_PATH}/taxonomy" -xzf "${LOCAL_DB_PATH}/taxonomy/taxdump.tar.gz" names.dmp nodes.dmp
 
-if [[ ! -s "$nodes" || ! -s "$names" ]]; then
-  echo "Taxonomy files missing" >&2
-  exit 1
-fi
+  if [[ ! -s "$nodes" || ! -s "$names" ]]; then
+    echo "Taxonomy files missing" >&2
+    exit 1
+  fi
 
-echo "[INFO] Fixing taxonomy ranks for Diamond compatibility"
-# Diamond only recognizes these ranks: superkingdom, kingdom, phylum, class, order, family, genus, species, subspecies, varietas, forma, no rank
-# Replace 'domain' with 'superkingdom' and any invalid rank with 'no rank'
+  echo "[INFO] Fixing taxonomy ranks for Diamond compatibility"
+  # Diamond only recognizes these ranks: superkingdom, kingdom, phylum, class, order, family, genus, species, subspecies, varietas, forma, no rank
+  # Replace 'domain' with 'superkingdom' and any invalid rank with 'no rank'
 
-awk 'BEGIN {
-  valid["superkingdom"]=1; valid["kingdom"]=1; valid["phylum"]=1; valid["class"]=1
-  valid["order"]=1; valid["family"]=1; valid["genus"]=1; valid["species"]=1
-  valid["subspecies"]=1; valid["varietas"]=1; valid["forma"]=1; valid["no rank"]=1
-  FS="\t\\|\t"; OFS="\t|\t"
-}
-{
-  # Field 3 is the rank
-  if ($3 == "domain") {
-    $3 = "superkingdom"
-  } else if (!($3 in valid)) {
-    $3 = "no rank"
+  awk 'BEGIN {
+    valid["superkingdom"]=1; valid["kingdom"]=1; valid["phylum"]=1; valid["class"]=1
+    valid["order"]=1; valid["family"]=1; valid["genus"]=1; valid["species"]=1
+    valid["subspecies"]=1; valid["varietas"]=1; valid["forma"]=1; valid["no rank"]=1
+    FS="\t\\|\t"; OFS="\t|\t"
   }
-  print
-}' "$nodes" > "${nodes}.tmp" && mv "${nodes}.tmp" "$nodes"
-
-echo "[INFO] Make diamond db (SwissProt only)"
-uniprot_sprot_building="${LOCAL_DB_PATH}/fasta/uniprot_sprot.building"
-diamond makedb -p "$(nproc)" \
-  -d $uniprot_sprot_building \
-  --in $uniprot_sprot_file \
-  --taxonmap $taxonmap_file \
-  --taxonnodes $nodes \
-  --taxonnames $names
-diamond dbinfo -d $uniprot_sprot_building > /dev/null \
-  && mv -f "$uniprot_sprot_building.dmnd" "$LOCAL_DB_PATH/diamond/uniprot_sprot.dmnd"
-
-
-echo "[INFO] Make diamond db (SwissProt and TrEMBL) (~3h)"
-uniprot_all_building="${LOCAL_DB_PATH}/fasta/uniprot_all.building"
-diamond makedb -p "$(nproc)" \
-  -d $uniprot_all_building \
-  --in $uniprot_all_file \
-  --taxonmap $taxonmap_file \
-  --taxonnodes $nodes \
-  --taxonnames $names
-diamond dbinfo -d $uniprot_all_building > /dev/null \
-  && mv -f "$uniprot_all_building.dmnd" "$LOCAL_DB_PATH/diamond/uniprot_all.dmnd"
-
-echo "[INFO] Generate taxonomy JSON helpers"
-python "${SCRIPT_DIR}/create_taxonomy_json.py"
+  {
+    # Field 3 is the rank
+    if ($3 == "domain") {
+      $3 = "superkingdom"
+    } else if (!($3 in valid)) {
+      $3 = "no rank"
+    }
+    print
+  }' "$nodes" > "${nodes}.tmp" && mv "${nodes}.tmp" "$nodes"
+  manifest_set checksums.taxdump "$md5"
+  taxonomy_key=${taxonomy_key:-$md5}
+  step_finished taxonomy "$taxonomy_key"
+fi
+
+makedb() {
+  local name=$1 in=$2 threads=$3
+  local building="${LOCAL_DB_PATH}/fasta/${name}.building"
+  diamond makedb -p "$threads" \
+    -d "$building" \
+    --in "$in" \
+    --taxonmap "$taxonmap_file" \
+    --taxonnodes "$nodes" \
+    --taxonnames "$names"
+  diamond dbinfo -d "$building" > /dev/null \
+    && mv -f "${building}.dmnd" "$LOCAL_DB_PATH/diamond/${name}.dmnd"
+}
+
+db_key=$(key_of "$uniprot_key" "$taxonomy_key")
+sprot_dmnd="$LOCAL_DB_PATH/diamond/uniprot_sprot.dmnd"
+all_dmnd="$LOCAL_DB_PATH/diamond/uniprot_all.dmnd"
+build_sprot=true
+build_all=true
+step_done makedb_sprot "$db_key" "$sprot_dmnd" && build_sprot=false
+step_done makedb_all "$db_key" "$all_dmnd" && build_all=false
+
+# Each makedb holds the accession to taxid map in memory, about three times
+# the size of taxonmap.tsv; both run at once when two of them fit
+makedb_memory=$(( $(stat -c %s "$taxonmap_file") * 3 ))
+available=$(cd "$SCRIPT_DIR" && python -c "import utils; print(utils.available_memory() or 0)")
+if [[ "$build_sprot" == true && "$build_all" == true ]] && (( available >= 2 * makedb_memory )); then
+  echo "[INFO] Make diamond dbs (SwissProt only, and SwissProt and TrEMBL) concurrently (~3h)"
+  makedb uniprot_sprot "$uniprot_sprot_file" "$(nproc)" &
+  sprot_pid=$!
+  makedb uniprot_all "$uniprot_all_file" "$(nproc)"
+  wait $sprot_pid
+  step_finished makedb_sprot "$db_key"
+  step_finished makedb_all "$db_key"
+else
+  if [[ "$build_sprot" == true ]]; then
+    echo "[INFO] Make diamond db (SwissProt only)"
+    makedb uniprot_sprot "$uniprot_sprot_file" "$(nproc)"
+    step_finished makedb_sprot "$db_key"
+  fi
+  if [[ "$build_all" == true ]]; then
+    echo "[INFO] Make diamond db (SwissProt and TrEMBL) (~3h)"
+    makedb uniprot_all "$uniprot_all_file" "$(nproc)"
+    step_finished makedb_all "$db_key"
+  fi
+fi
+
+if ! step_done taxonomy_json "$db_key" "${LOCAL_DB_PATH}/taxonomy/taxid2dbsize.json"; then
+  echo "[INFO] Generate taxonomy JSON helpers and per-taxon sequence counts"
+  python "${SCRIPT_DIR}/create_taxonomy_json.py"
+  step_finished taxonomy_json "$db_key"
+fi
+
+# Optional clade databases, from --clades=TAXID,TAXID or "clade_dbs" in config.json
+if [[ -z "$CLADES" ]]; then
+  CLADES=$(jq -r '(.clade_dbs // []) | map(tostring) | join(",")' "$CONFIG_FILE")
+fi
+if [[ -n "$CLADES" ]]; then
+  clades_key=$(key_of "$db_key" "$CLADES")
+  if ! step_done clades "$clades_key" "${LOCAL_DB_PATH}/diamond/clades/manifest.json"; then
+    echo "[INFO] Make clade diamond dbs ($CLADES)"
+    python "${SCRIPT_DIR}/create_clade_db.py" "$CLADES"
+    step_finished clades "$clades_key"
+  fi
+fi
 
 echo "[DONE]"
 echo
 if [[ "$REFRESH_MODE" == true ]]; then
-  echo "Database successfully refreshed in $LOCAL_DB_PATH"
+  echo "Database successfully refreshed in $LOCAL_DB_PATH (UniProt release $(manifest_get uniprot_release))"
 else
-  echo "Database successfully created in $LOCAL_DB_PATH"
+  echo "Database successfully created in $LOCAL_DB_PATH (UniProt release $(manifest_get uniprot_release))"
   echo "To refresh the database in the future, use: $0 --refresh"
 fi
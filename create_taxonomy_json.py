@@ -5,6 +5,7 @@ from collections import defaultdict
 import numpy as np
 import pandas as pd
 import pickle
+import taxonomy
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_absolute_error, r2_score
@@ -75,3 +76,74 @@ with open(children_path, 'w') as f:
 taxid_to_name_path = os.path.join(local_db_path, "taxonomy", "taxid2scientific_name.json")
 with open(taxid_to_name_path, 'w') as f:
     json.dump(taxid_to_name, f)
+
+# Per-taxon sequence counts: direct counts of all sequences and of the SwissProt
+# ones, then accumulated bottom-up over the taxonomy. extract_headers.py counts
+# both in its pass over the headers; without its output, they are recounted from
+# the taxon mapping and the SwissProt FASTA.
+taxonmap_path = os.path.join(local_db_path, "mapping", "taxonmap.tsv")
+taxon_counts_path = os.path.join(local_db_path, "mapping", "taxon_counts.tsv")
+sprot_path = os.path.join(local_db_path, "fasta", "uniprot_sprot.fasta")
+if not os.path.isfile(taxonmap_path) and not os.path.isfile(taxon_counts_path):
+    print(f"[ERROR] taxonmap.tsv not found at {taxonmap_path}. Local database is not correctly set up. Please retry to execute create_local_db.sh")
+    exit()
+
+total_count = defaultdict(int)
+swissprot_count = defaultdict(int)
+if os.path.isfile(taxon_counts_path):
+    with open(taxon_counts_path, "r") as f:
+        next(f, None)
+        for line in f:
+            taxid, total, swissprot = line.split("\t")
+            total_count[int(taxid)] = int(total)
+            if int(swissprot):
+                swissprot_count[int(taxid)] = int(swissprot)
+else:
+    with open(taxonmap_path, "r") as f:
+        next(f, None)
+        for line in f:
+            parts = line.split("\t", 3)
+            if len(parts) < 3 or not parts[2].isdigit():
+                continue
+            total_count[int(parts[2])] += 1
+    if os.path.isfile(sprot_path):
+        with open(sprot_path, "r") as f:
+            for line in f:
+                if line.startswith(">"):
+                    pos = line.find(" OX=")
+                    if pos != -1:
+                        taxid = line[pos + 4:].split(" ", 1)[0].strip()
+                        if taxid.isdigit():
+                            swissprot_count[int(taxid)] += 1
+    else:
+        print(f"[WARNING] uniprot_sprot.fasta not found at {sprot_path}. SwissProt counts will be 0.")
+
+# Breadth-first order from the root, reversed, visits every child before its parent
+order = [1]
+for taxid in order:
+    for child in children.get(taxid, ()):
+        if child != taxid:
+            order.append(child)
+for taxid in reversed(order):
+    par = parent.get(taxid)
+    if par is None or par == taxid:
+        continue
+    if taxid in total_count:
+        total_count[par] += total_count[taxid]
+    if taxid in swissprot_count:
+        swissprot_count[par] += swissprot_count[taxid]
+
+taxid_to_dbsize = {
+    taxid: {"swissprot": swissprot_count.get(taxid, 0), "total": total}
+    for taxid, total in total_count.items()
+    if total > 0
+}
+taxid_to_dbsize_path = os.path.join(local_db_path, "taxonomy", "taxid2dbsize.json")
+with open(taxid_to_dbsize_path, 'w') as f:
+    json.dump(taxid_to_dbsize, f)
+
+# Compact memory-mapped copy of the same data, opened by utils when present
+taxonomy.write_store(
+    os.path.join(local_db_path, "taxonomy"),
+    parent, rank, children, taxid_to_name, total_count, swissprot_count
+)
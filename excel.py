@@ -1,120 +1,161 @@
-import openpyxl
-from openpyxl.styles import Font
-from openpyxl.styles import PatternFill
-from openpyxl.styles import Border, Side
+import argparse
+import csv
+import importlib.util
 import utils
 
-taxid2name = utils.get_taxid_to_scientificname()
-
-def write_excel(data, filename, header_bg="eeffed"):
-    lengths = [len(v) for v in data.values()]
-    if len(set(lengths)) != 1:
-        length_check = {k: len(v) for k, v in data.items()}
-        print(f"Column lengths: {length_check}")
-        raise ValueError("All columns must have the same number of rows.")
-    
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    headers = list(data.keys())
-    ws.append(headers)
-    for row in range(len(next(iter(data.values())))):
-        ws.append([data[header][row] for header in headers])
-    border = Side(border_style="thin")
-    for cell in ws["1:1"]:
-        cell.font = Font(bold=True)
-        cell.fill = PatternFill('solid', start_color=header_bg)
-        cell.border = Border(left=border, right=border, top=border, bottom=border)
-        
-    for column in ws.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            if cell.value and len(str(cell.value)) > max_length:
-                max_length = len(cell.value)
-        ws.column_dimensions[column_letter].width = min(50, max_length + 2)    
-    wb.save(filename)
+HEADERS = [
+    "Query accession",
+    "Subject accession",
+    "Subject description",
+    "Subject species (taxid)",
+    "Subject species (name)",
+    "Gene Name",
+    "Bitscore",
+    "Evalue",
+    "Identity (%)",
+    "Similarity (%)",
+    "Query coverage (%)",
+    "Subject coverage (%)",
+    "Common ancestor (rank)",
+    "Common ancestor (taxID)",
+    "Common ancestor (name)",
+    "Hit found"
+]
+# Rows per sheet, header included
+MAX_SHEET_ROWS = 1048576
+MAX_COLUMN_WIDTH = 50
+TABLE_FORMATS = ("xlsx", "tsv", "parquet")
+
+
+class Table:
+    # Rows of one output table, with the column widths measured while they are added
+    def __init__(self, name):
+        self.name = name
+        self.rows = []
+        self.widths = [len(header) for header in HEADERS]
+
+    def append(self, row):
+        self.rows.append(row)
+        for i, value in enumerate(row):
+            length = len(str(value))
+            if length > self.widths[i]:
+                self.widths[i] = length
+
+
+def build_tables(query_ids, assigned):
+    output_data = Table("Sheet")
+    output_top3 = Table("Top3 hits")
+    for qid in query_ids:
+        if qid in assigned:
+            hits = assigned[qid]
+            output_data.append(hit_row(hits[0]))
+            for hit in hits:
+                output_top3.append(hit_row(hit))
+        else:
+            row = no_hit_row(qid)
+            output_data.append(row)
+            output_top3.append(row)
+    return output_data, output_top3
 
-def add_sheet(data, filename, sheet_name, header_bg="eeffed"):
-    lengths = [len(v) for v in data.values()]
-    if len(set(lengths)) != 1:
-        length_check = {k: len(v) for k, v in data.items()}
-        print(f"Column lengths: {length_check}")
-        raise ValueError("All columns must have the same number of rows.")
-    
-    try:
-        wb = openpyxl.load_workbook(filename)
-    except FileNotFoundError:
-        wb = openpyxl.Workbook()
-        if len(wb.sheetnames) == 1 and wb.active.max_row <= 1:
-            wb.remove(wb.active)
-    
-    if sheet_name in wb.sheetnames:
-        del wb[sheet_name]
-    
-    ws = wb.create_sheet(sheet_name)
-    
-    headers = list(data.keys())
-    ws.append(headers)
-    for row in range(len(next(iter(data.values())))):
-        ws.append([data[header][row] for header in headers])
-    
+
+def hit_row(hit):
+    # Looked up at call time: main.py loads the names after importing this module
+    taxid2name = utils.get_taxid_to_scientificname() or {}
+    return (
+        hit.qseqid,
+        hit.sseqid,
+        hit.stitle,
+        str(hit.staxid or ""),
+        taxid2name.get(str(hit.staxid), "") if hit.staxid else "",
+        utils.gene_name_from_stitle(hit.stitle),
+        f"{hit.bits:.1f}",
+        f"{hit.evalue:.1e}",
+        f"{hit.pident:.2f}",
+        f"{hit.ppos:.2f}",
+        f"{hit.qcov*100:.2f}",
+        f"{hit.scov*100:.2f}",
+        hit.common_ancestor_rank,
+        hit.common_ancestor_taxid,
+        hit.common_ancestor_name,
+        "True"
+    )
+
+
+def no_hit_row(qid):
+    return (qid,) + ("",) * (len(HEADERS) - 2) + ("False",)
+
+
+def write_tables(tables, filename, header_bg="eeffed"):
+    # One pass over a write-only workbook: rows go straight to the file, tables
+    # longer than the Excel row limit continue on "<name> (2)", "<name> (3)", ...
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Border, Side
+    from openpyxl.utils import get_column_letter
+    wb = openpyxl.Workbook(write_only=True)
     border = Side(border_style="thin")
-    for cell in ws["1:1"]:
-        cell.font = Font(bold=True)
-        cell.fill = PatternFill('solid', start_color=header_bg)
-        cell.border = Border(left=border, right=border, top=border, bottom=border)
-    
-    # Auto-adjust column widths
-    for column in ws.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            if cell.value and len(str(cell.value)) > max_length:
-                max_length = len(str(cell.value))
-        ws.column_dimensions[column_letter].width = min(50, max_length + 2)
-    
+    for table in tables:
+        per_sheet = MAX_SHEET_ROWS - 1
+        for part, start in enumerate(range(0, max(len(table.rows), 1), per_sheet), start=1):
+            ws = wb.create_sheet(table.name if part == 1 else f"{table.name} ({part})")
+            # Column widths have to be set before the first row is written
+            for i, width in enumerate(table.widths, start=1):
+                ws.column_dimensions[get_column_letter(i)].width = min(MAX_COLUMN_WIDTH, width + 2)
+            header = []
+            for value in HEADERS:
+                cell = WriteOnlyCell(ws, value=value)
+                cell.font = Font(bold=True)
+                cell.fill = PatternFill('solid', start_color=header_bg)
+                cell.border = Border(left=border, right=border, top=border, bottom=border)
+                header.append(cell)
+            ws.append(header)
+            for row in table.rows[start:start + per_sheet]:
+                ws.append(row)
     wb.save(filename)
 
 
-def add_hit(output_data, hit):
-    output_data["Query accession"].append(hit.get("qseqid", ""))
-    output_data["Subject accession"].append(hit.get("sseqid",""))
-    output_data["Subject description"].append(hit.get("stitle",""))
-    output_data["Subject species (taxid)"].append(str(hit.get("staxid") or ""))
-    output_data["Subject species (name)"].append(taxid2name.get(str(hit.get("staxid")), "") if hit.get("staxid") else "")
-    output_data["Gene Name"].append(utils.gene_name_from_stitle(hit.get("stitle","")))
-    output_data["Bitscore"].append(f"{hit.get('bits',0):.1f}")
-    output_data["Evalue"].append(f"{hit.get('evalue',0):.1e}")
-    output_data["Identity (%)"].append(f"{hit.get('pident',0):.2f}")
-    output_data["Similarity (%)"].append(f"{hit.get('ppos',0):.2f}") 
-    output_data["Query coverage (%)"].append(f"{hit.get('_qcov',0)*100:.2f}")
-    output_data["Subject coverage (%)"].append(f"{hit.get('_scov',0)*100:.2f}")
-    output_data["Common ancestor (rank)"].append(hit.get("common_ancestor_rank",""))
-    output_data["Common ancestor (taxID)"].append(hit.get("common_ancestor_taxid",""))
-    output_data["Common ancestor (name)"].append(hit.get("common_ancestor_name",""))
-    output_data["Hit found"].append("True")    
-
-    return output_data
-
-
-def add_no_hit(output_data, qid):
-    output_data["Query accession"].append(qid)
-    output_data["Subject accession"].append("")
-    output_data["Subject description"].append("")
-    output_data["Subject species (taxid)"].append("")
-    output_data["Subject species (name)"].append("")
-    output_data["Gene Name"].append("")
-    output_data["Bitscore"].append("")
-    output_data["Evalue"].append("")
-    output_data["Identity (%)"].append("")
-    output_data["Similarity (%)"].append("")
-    output_data["Query coverage (%)"].append("")
-    output_data["Subject coverage (%)"].append("")
-    output_data["Common ancestor (rank)"].append("")
-    output_data["Common ancestor (taxID)"].append("")
-    output_data["Common ancestor (name)"].append("")
-    output_data["Hit found"].append("False")
-    
-    return output_data
+def check_table_format(table_format):
+    # Checked before the searches start rather than when the results are written
+    if table_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        print("[ERROR] Parquet output requires pyarrow (pip install pyarrow)")
+        exit(1)
+
+def check_run_args(run_args):
+    # --table-format among the main.py options of a batch or shard run
+    parser = argparse.ArgumentParser(prog="main.py", add_help=False)
+    parser.add_argument('--table-format', default='xlsx', choices=TABLE_FORMATS)
+    options, _ = parser.parse_known_args(run_args)
+    check_table_format(options.table_format)
+
+def write_columnar(tables, base_path, table_format):
+    # Same tables for pipelines: <base>.tsv / <base>_top3.tsv, or .parquet
+    paths = []
+    for table, suffix in zip(tables, ("", "_top3")):
+        path = f"{base_path}{suffix}.{table_format}"
+        if table_format == "tsv":
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+                writer.writerow(HEADERS)
+                writer.writerows(table.rows)
+        else:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                print("[ERROR] Parquet output requires pyarrow (pip install pyarrow)")
+                exit(1)
+            columns = list(zip(*table.rows)) if table.rows else [()] * len(HEADERS)
+            pyarrow.parquet.write_table(
+                pyarrow.table({header: [str(v) for v in column] for header, column in zip(HEADERS, columns)}),
+                path
+            )
+        paths.append(path)
+    return paths
 
 
+def write_results(query_ids, assigned, output_excel_file, table_format="xlsx"):
+    tables = build_tables(query_ids, assigned)
+    if table_format == "xlsx":
+        write_tables(tables, output_excel_file)
+        return [output_excel_file]
+    return write_columnar(tables, output_excel_file[:-len(".xlsx")], table_format)
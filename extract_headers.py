@@ -0,0 +1,132 @@
+import argparse
+import os
+import re
+from collections import defaultdict
+from multiprocessing import Pool
+
+# One parallel pass over the UniProt FASTA headers, used by create_local_db.sh.
+# The file is cut into byte ranges starting at a '>' and each worker writes its
+# part of the outputs; the parts are then concatenated in order:
+#   mapping/taxonmap.tsv      accession -> taxid, for diamond makedb --taxonmap
+#   mapping/headers.tsv       accession, entry name, reviewed, taxid, gene name, length
+#   mapping/taxon_counts.tsv  taxid, sequences, SwissProt sequences (direct counts,
+#                             accumulated over the taxonomy by create_taxonomy_json.py)
+# Usage: python extract_headers.py uniprot_all.fasta MAPPING_DIR [--jobs N]
+OX_RE = re.compile(rb" OX=(\d+)")
+GN_RE = re.compile(rb" GN=(\S+)")
+CHUNK_BYTES = 256 * 1024 * 1024
+
+
+def chunk_ranges(path, jobs):
+    size = os.path.getsize(path)
+    n_chunks = max(jobs, -(-size // CHUNK_BYTES))
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_chunks):
+            f.seek(max(bounds[-1], size * i // n_chunks))
+            # Move to the start of the next record
+            f.readline()
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line or line.startswith(b'>'):
+                    break
+            if pos > bounds[-1] and pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def extract(task):
+    path, index, start, end, out_dir = task
+    counts = defaultdict(lambda: [0, 0])
+    taxonmap_part = os.path.join(out_dir, f".taxonmap.{index:05d}")
+    headers_part = os.path.join(out_dir, f".headers.{index:05d}")
+    with open(path, 'rb') as f, open(taxonmap_part, 'wb') as taxonmap, open(headers_part, 'wb') as headers:
+        f.seek(start)
+        record = None
+        length = 0
+        position = start
+
+        def flush():
+            acc, entry, reviewed, taxid, gene = record
+            headers.write(b"%s\t%s\t%d\t%s\t%s\t%d\n" % (acc, entry, reviewed, taxid, gene, length))
+
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            if line.startswith(b'>'):
+                if record:
+                    flush()
+                ids = line[1:].split(None, 1)[0].split(b'|')
+                match = OX_RE.search(line)
+                record = None
+                if len(ids) >= 3 and match:
+                    taxid = match.group(1)
+                    gene = GN_RE.search(line)
+                    reviewed = ids[0] == b'sp'
+                    record = (ids[1], ids[2], reviewed, taxid, gene.group(1) if gene else b'')
+                    taxonmap.write(b"%s\t%s\t%s\t0\n" % (ids[1], ids[1], taxid))
+                    count = counts[int(taxid)]
+                    count[0] += 1
+                    count[1] += reviewed
+                length = 0
+            elif record:
+                length += len(line.strip())
+        if record:
+            flush()
+    return index, dict(counts)
+
+def concatenate(parts, out_path, header):
+    building = out_path + '.building'
+    with open(building, 'wb') as out:
+        out.write(header)
+        for part in parts:
+            with open(part, 'rb') as f:
+                while True:
+                    block = f.read(1 << 24)
+                    if not block:
+                        break
+                    out.write(block)
+            os.remove(part)
+    os.replace(building, out_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract taxonmap, header metadata and per-taxon counts from a UniProt FASTA")
+    parser.add_argument('fasta', help='UniProt FASTA (SwissProt and TrEMBL)')
+    parser.add_argument('out_dir', help='Output directory (the mapping directory of the local database)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    ranges = chunk_ranges(args.fasta, args.jobs)
+    print(f"[INFO] Extract headers of {args.fasta} in {len(ranges)} chunks with {args.jobs} processes")
+    tasks = [(args.fasta, i, start, end, args.out_dir) for i, (start, end) in enumerate(ranges)]
+    counts = defaultdict(lambda: [0, 0])
+    with Pool(args.jobs) as pool:
+        for _, part_counts in pool.imap_unordered(extract, tasks):
+            for taxid, (total, swissprot) in part_counts.items():
+                counts[taxid][0] += total
+                counts[taxid][1] += swissprot
+
+    concatenate(
+        [os.path.join(args.out_dir, f".taxonmap.{i:05d}") for i in range(len(tasks))],
+        os.path.join(args.out_dir, "taxonmap.tsv"),
+        b"accession\taccession.version\ttaxid\tgi\n"
+    )
+    concatenate(
+        [os.path.join(args.out_dir, f".headers.{i:05d}") for i in range(len(tasks))],
+        os.path.join(args.out_dir, "headers.tsv"),
+        b"accession\tentry_name\treviewed\ttaxid\tgene_name\tlength\n"
+    )
+    counts_path = os.path.join(args.out_dir, "taxon_counts.tsv")
+    with open(counts_path + '.building', 'w') as f:
+        f.write("taxid\ttotal\tswissprot\n")
+        for taxid in sorted(counts):
+            f.write(f"{taxid}\t{counts[taxid][0]}\t{counts[taxid][1]}\n")
+    os.replace(counts_path + '.building', counts_path)
+    print(f"[INFO] {sum(c[0] for c in counts.values())} sequences of {len(counts)} taxa")
+
+if __name__ == "__main__":
+    main()
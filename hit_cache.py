@@ -0,0 +1,148 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import homology
+
+# Content-addressed cache of the hits selected at each taxonomic step, shared by
+# all runs using the same local database. Entries are keyed on the SHA-1 of the
+# query sequence, so renamed or re-annotated proteins reuse earlier searches.
+# An empty entry records that the sequence has no hit at that step.
+CACHE_FILE = "hits.sqlite"
+DEFAULT_MAX_MB = 2048
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hits (
+    seq_hash TEXT NOT NULL,
+    db_release TEXT NOT NULL,
+    step_key TEXT NOT NULL,
+    swissprot_only INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    hits BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (seq_hash, db_release, step_key, swissprot_only, mode)
+);
+CREATE INDEX IF NOT EXISTS hits_last_used ON hits (last_used);
+CREATE TABLE IF NOT EXISTS releases (
+    swissprot_only INTEGER PRIMARY KEY,
+    db_release TEXT NOT NULL
+);
+"""
+
+
+def cache_path(local_db_path):
+    return os.path.join(local_db_path, "cache", CACHE_FILE)
+
+def db_release(dmnd_path):
+    # Any rebuild of the .dmnd changes its size or modification time
+    st = os.stat(dmnd_path)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+def step_key(curr_tax, taxonlist, ex_tax=None):
+    # The taxon list depends on the previous step and the exclusions are applied
+    # to the hits, so both are part of what was searched at this step.
+    searched = ",".join(str(t) for t in sorted(taxonlist))
+    excluded = ",".join(str(t) for t in sorted(ex_tax or []))
+    digest = hashlib.sha1(f"{searched}|{excluded}".encode()).hexdigest()[:16]
+    return f"{curr_tax}:{digest}"
+
+def to_rows(hits):
+    return [
+        (h.sseqid, h.pident, h.ppos, h.alen, h.evalue, h.bits, h.qlen, h.slen, h.staxid, h.stitle, h.qcov, h.scov)
+        for h in hits
+    ]
+
+def from_rows(rows, qseqid, group, step):
+    group = homology.ancestor(*group)
+    hits = []
+    for sseqid, pident, ppos, alen, evalue, bits, qlen, slen, staxid, stitle, qcov, scov in rows:
+        hits.append(homology.Hit(
+            qseqid, sseqid, pident, ppos, alen, evalue, bits, qlen, slen, staxid, stitle, group,
+            qcov, scov, (step, -bits, -pident)
+        ))
+    return hits
+
+
+class HitCache:
+    def __init__(self, path, dmnd_path, swissprot_only, mode, max_mb=DEFAULT_MAX_MB):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=300)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.release = db_release(dmnd_path)
+        self.swissprot_only = int(bool(swissprot_only))
+        self.mode = mode
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._invalidate()
+
+    def _invalidate(self):
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT db_release FROM releases WHERE swissprot_only = ?", (self.swissprot_only,)
+            ).fetchone()
+            if row and row[0] == self.release:
+                return
+            deleted = self.conn.execute(
+                "DELETE FROM hits WHERE swissprot_only = ? AND db_release != ?",
+                (self.swissprot_only, self.release)
+            ).rowcount
+            self.conn.execute(
+                "INSERT OR REPLACE INTO releases (swissprot_only, db_release) VALUES (?, ?)",
+                (self.swissprot_only, self.release)
+            )
+        if row:
+            print(f"[INFO] DIAMOND database changed, {deleted} cached hit entries invalidated", flush=True)
+
+    def lookup(self, seq_hashes, key):
+        found = {}
+        hashes = list(set(seq_hashes))
+        now = time.time()
+        with self.conn:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                params = (self.release, key, self.swissprot_only, self.mode, *chunk)
+                for seq_hash, blob in self.conn.execute(
+                    "SELECT seq_hash, hits FROM hits WHERE db_release = ? AND step_key = ? "
+                    f"AND swissprot_only = ? AND mode = ? AND seq_hash IN ({marks})",
+                    params
+                ):
+                    found[seq_hash] = pickle.loads(blob)
+                self.conn.execute(
+                    f"UPDATE hits SET last_used = ? WHERE db_release = ? AND step_key = ? "
+                    f"AND swissprot_only = ? AND mode = ? AND seq_hash IN ({marks})",
+                    (now, *params)
+                )
+        return found
+
+    def store(self, entries, key):
+        now = time.time()
+        rows = []
+        for seq_hash, hit_rows in entries.items():
+            blob = pickle.dumps(hit_rows, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((seq_hash, self.release, key, self.swissprot_only, self.mode, blob, len(blob), now))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.evict()
+
+    def evict(self):
+        # Least recently used entries go first, down to 90% of the size limit
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        removed = 0
+        victims = []
+        for rowid, size in self.conn.execute("SELECT rowid, size FROM hits ORDER BY last_used"):
+            victims.append((rowid,))
+            removed += size
+            if removed >= target:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM hits WHERE rowid = ?", victims)
+        print(f"[INFO] Hit cache over {self.max_bytes // (1024 * 1024)} MB, {len(victims)} least recently used entries evicted", flush=True)
+
+    def close(self):
+        self.conn.close()
@@ -1,7 +1,96 @@
 import utils
+import heapq
 import os
 import shutil
 import subprocess
+import sys
+import time
+
+MIN_BITS = 50.0
+_ANCESTORS = {}
+
+
+def ancestor(taxid, name, rank):
+    # Every hit of a step shares the same (taxid, name, rank) tuple
+    group = (taxid, sys.intern(str(name)), sys.intern(str(rank)))
+    return _ANCESTORS.setdefault(group, group)
+
+
+class Hit:
+    # Compact record of one DIAMOND hit: no per-instance __dict__, ancestors
+    # and the subject IDs and titles of kept hits are interned and shared.
+    __slots__ = (
+        "qseqid", "sseqid", "pident", "ppos", "alen", "evalue", "bits",
+        "qlen", "slen", "staxid", "stitle", "ancestor", "qcov", "scov", "key"
+    )
+
+    def __init__(self, qseqid, sseqid, pident, ppos, alen, evalue, bits, qlen, slen, staxid, stitle, ancestor,
+                 qcov=0.0, scov=0.0, key=None):
+        self.qseqid = qseqid
+        self.sseqid = sseqid
+        self.pident = pident
+        self.ppos = ppos
+        self.alen = alen
+        self.evalue = evalue
+        self.bits = bits
+        self.qlen = qlen
+        self.slen = slen
+        self.staxid = staxid
+        self.stitle = stitle
+        self.ancestor = ancestor
+        self.qcov = qcov
+        self.scov = scov
+        self.key = key
+
+    def __reduce__(self):
+        return (Hit, tuple(getattr(self, name) for name in Hit.__slots__))
+
+    def __repr__(self):
+        return f"Hit({self.qseqid!r}, {self.sseqid!r}, bits={self.bits}, staxid={self.staxid})"
+
+    @property
+    def common_ancestor_taxid(self):
+        return self.ancestor[0]
+
+    @property
+    def common_ancestor_name(self):
+        return self.ancestor[1]
+
+    @property
+    def common_ancestor_rank(self):
+        return self.ancestor[2]
+
+    def for_query(self, qseqid):
+        return Hit(
+            qseqid, self.sseqid, self.pident, self.ppos, self.alen, self.evalue, self.bits,
+            self.qlen, self.slen, self.staxid, self.stitle, self.ancestor, self.qcov, self.scov, self.key
+        )
+
+    @classmethod
+    def from_dict(cls, h):
+        # Hits saved as dicts by older versions
+        return cls(
+            h["qseqid"], h["sseqid"], h["pident"], h["ppos"], h["alen"], h["evalue"], h["bits"],
+            h["qlen"], h["slen"], h["staxid"], h.get("stitle", ""),
+            ancestor(h["common_ancestor_taxid"], h["common_ancestor_name"], h["common_ancestor_rank"]),
+            h.get("_qcov", 0.0), h.get("_scov", 0.0), h.get("_key")
+        )
+
+
+def as_hits(assigned):
+    return {q: [h if isinstance(h, Hit) else Hit.from_dict(h) for h in hits] for q, hits in assigned.items()}
+
+
+def expand_duplicates(best, duplicates):
+    # Give every member of a group of identical sequences the hits of its representative
+    expanded = {}
+    for q, hits in best.items():
+        expanded[q] = hits
+        for member in duplicates.get(q, ()):
+            if member != q:
+                expanded[member] = [h.for_query(member) for h in hits]
+    return expanded
+
 
 def which_or_die(bin_name):
     path = shutil.which(bin_name)
@@ -10,108 +99,300 @@ def which_or_die(bin_name):
         exit()
     return path
 
-def build_taxon_list(curr_tax, excluded_tax):
+def build_taxon_list(curr_tax, excluded_tax, swissprot_only=False, ex_tax=None):
+    # excluded_tax is the clade searched at the previous step. Taxa without any
+    # sequence in the local database are dropped, and the subtrees excluded with
+    # --ex-tax (ex_tax) are cut out of the list by listing their siblings instead.
+    counts = utils.get_taxid_to_dbsize()
+    count_key = 'swissprot' if swissprot_only else 'total'
+    ex_roots = set(ex_tax or [])
+    ex_ancestors = set()
+    for root in ex_roots:
+        parent = utils.PARENT.get(str(root))
+        while parent is not None and parent not in ex_ancestors:
+            ex_ancestors.add(parent)
+            next_parent = utils.PARENT.get(str(parent))
+            parent = None if next_parent == parent else next_parent
+
+    def count(taxid):
+        return counts.get(str(taxid), {}).get(count_key, 0)
+
+    def expand(taxid):
+        if taxid in ex_roots:
+            return []
+        if not counts:
+            return [taxid]
+        if count(taxid) == 0:
+            return []
+        children = utils.CHILDREN.get(str(taxid)) or []
+        if taxid in ex_ancestors and children:
+            # Sequences annotated on the node itself cannot be listed without its
+            # whole subtree: keep it and let the hits be filtered after the search
+            if count(taxid) > sum(count(child) for child in children if child != taxid):
+                return [taxid]
+            return [t for child in children if child != taxid for t in expand(child)]
+        return [taxid]
+
     taxon_list = []
     if utils.CHILDREN.get(str(curr_tax)):
         for child in utils.CHILDREN[str(curr_tax)]:
-            if child != excluded_tax:
-                taxon_list.append(child)
+            if child != excluded_tax and child != curr_tax:
+                taxon_list.extend(expand(child))
     else:
-        taxon_list.append(curr_tax)
+        taxon_list.extend(expand(curr_tax))
     return taxon_list
 
-def run_diamond(run_id, query_fasta, taxonlist, group, threads=None, max_targets=50, mode="more-sensitive", excluded_tax=[], swissprot_only=False):
+def run_diamond(run_id, query_fasta, taxonlist, group, threads=None, max_targets=50, mode="more-sensitive", excluded_tax=frozenset(), swissprot_only=False, metrics=None, block_size=None, index_chunks=None):
     if group[0] in excluded_tax:
-        return []
+        return iter(())
     
     diamond = which_or_die("diamond")
-    out_path = os.path.join(utils.working_dir(run_id), f".diamond_tmp_{os.getpid()}.tsv")
+    db_dmnd, full_letters = utils.select_db(swissprot_only, taxonlist)
     args = [
         diamond, "blastp",
-        "-d", utils.get_db_dmnd(swissprot_only),
+        "-d", db_dmnd,
         "-q", query_fasta,
         "-k", str(max_targets),
         "-e", "1e-5",
         "-p", str(threads or os.cpu_count() or 1),
         "--" + mode,
         "-f", "6",
-        "qseqid","sseqid","pident","ppos","length","evalue","bitscore","qlen","slen","staxids","stitle",
-        "-o", out_path
+        "qseqid","sseqid","pident","ppos","length","evalue","bitscore","qlen","slen","staxids","stitle"
     ]
     args.extend(["--taxonlist", ",".join(str(t) for t in taxonlist)])
+    if full_letters:
+        args.extend(["--dbsize", str(full_letters)])
+    if block_size:
+        args.extend(["--block-size", str(block_size)])
+    if index_chunks:
+        args.extend(["--index-chunks", str(index_chunks)])
    
+    log_path = os.path.join(utils.working_dir(run_id), "diamond.log")
+    return _stream_hits(args, log_path, group, excluded_tax, taxonlist, metrics, block_size, index_chunks)
+
+def _stream_hits(args, log_path, group, excluded_tax, taxonlist, metrics, block_size, index_chunks):
+    # DIAMOND starts on the first next(), so an unconsumed stream never leaves
+    # a process behind. A consumer that stops early (close() or an exception)
+    # kills it; it is reaped and its log closed in every case.
     print("[INFO] Running DIAMOND:\n", " ".join(args), flush=True)
-    proc = subprocess.Popen(args, stdout=None, stderr=subprocess.PIPE, text=True)
-    _, stderr = proc.communicate()
+    # Hits are read from the pipe while DIAMOND is still searching. Its log goes
+    # to a file so that a full stderr pipe can never block the search.
+    log_f = open(log_path, "a")
+    try:
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=log_f,
+            text=True, encoding="utf-8", errors="replace", bufsize=1 << 20
+        )
+    except BaseException:
+        log_f.close()
+        raise
+    if metrics is not None:
+        metrics['diamond_runs'] = metrics.get('diamond_runs', 0) + 1
+        metrics['taxonlist_size'] = len(taxonlist)
+        metrics['block_size'] = block_size
+        metrics['index_chunks'] = index_chunks
+    # Parse time is the CPU time spent in parse_diamond_tsv, so waiting for
+    # DIAMOND output is not counted; the consumer's own time is selection time.
+    start = time.perf_counter()
+    parse_time = 0.0
+    n_hits = 0
+    finished = False
+    hits = parse_diamond_tsv(proc.stdout, group, excluded_tax)
+    try:
+        while True:
+            t = time.process_time()
+            try:
+                h = next(hits)
+            except StopIteration:
+                parse_time += time.process_time() - t
+                break
+            parse_time += time.process_time() - t
+            n_hits += 1
+            yield h
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+        proc.stdout.close()
+        # wait4 instead of wait() to get the resource usage of this DIAMOND process only
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        log_f.close()
+        if metrics is not None:
+            metrics['diamond_wall'] = metrics.get('diamond_wall', 0.0) + time.perf_counter() - start
+            metrics['diamond_cpu'] = metrics.get('diamond_cpu', 0.0) + usage.ru_utime + usage.ru_stime
+            # ru_maxrss is in kilobytes on Linux
+            metrics['diamond_peak_rss_mb'] = max(metrics.get('diamond_peak_rss_mb', 0.0), usage.ru_maxrss / 1024)
+            metrics['hits'] = metrics.get('hits', 0) + n_hits
+            metrics['parse_time'] = metrics.get('parse_time', 0.0) + parse_time
     if proc.returncode != 0:
-        msg = stderr.strip() or "Unknown error"
+        with open(log_path, "r", errors="replace") as f:
+            msg = "".join(f.readlines()[-20:]).strip() or "Unknown error"
         print(f"[ERROR] DIAMOND failed: {msg}", flush=True)
         exit()
 
-    hits = parse_diamond_tsv(out_path, group, excluded_tax)
-    try:
-        os.remove(out_path)
-    except OSError:
-        pass
-    return hits
-
-
-def parse_diamond_tsv(path, ancestor, excluded_tax):
-    hits = []
-    with open(path, "r", encoding="utf-8", errors="replace") as f:
-        for line in f:
-            if not line.strip():
-                continue
-            parts = line.rstrip("\n").split("\t")
-            qseqid = parts[0]
-            sseqid = parts[1]
-            pident = float(parts[2])
-            ppos = float(parts[3])
-            alen = int(parts[4])
-            evalue = float(parts[5])
-            bits = float(parts[6])
-            qlen = int(parts[7])
-            slen = int(parts[8])
-            stax_raw = parts[9]
-            staxid = None
-            if stax_raw:
-                staxid = int(stax_raw.split(";")[0])
-            if staxid in excluded_tax:
-                continue
-            stitle = parts[10] if len(parts) > 10 else ""
-            hits.append({
-                "qseqid": qseqid, "sseqid": sseqid, "pident": pident,
-                "ppos": ppos, "alen": alen, "evalue": evalue, "bits": bits,
-                "qlen": qlen, "slen": slen, "staxid": staxid, "stitle": stitle,
-                "common_ancestor_taxid": ancestor[0], "common_ancestor_name": ancestor[1],
-                "common_ancestor_rank": ancestor[2]
-            })
-    return hits
 
-def select_best_by_priority(hits, target_taxid, step,
-                            min_pid=0, min_qcov=0, min_scov=0, min_bits=50.0):
-    best_per_query = {}
-    for h in hits:
-        if h["qlen"] <= 0 or h["slen"] <= 0:
+def parse_diamond_tsv(lines, group, excluded_tax):
+    group = ancestor(*group)
+    for line in lines:
+        if not line.strip():
+            continue
+        parts = line.rstrip("\n").split("\t")
+        qseqid = parts[0]
+        sseqid = parts[1]
+        pident = float(parts[2])
+        ppos = float(parts[3])
+        alen = int(parts[4])
+        evalue = float(parts[5])
+        bits = float(parts[6])
+        qlen = int(parts[7])
+        slen = int(parts[8])
+        stax_raw = parts[9]
+        staxid = None
+        if stax_raw:
+            staxid = int(stax_raw.split(";")[0])
+        if staxid in excluded_tax:
+            continue
+        stitle = parts[10] if len(parts) > 10 else ""
+        yield Hit(qseqid, sseqid, pident, ppos, alen, evalue, bits, qlen, slen, staxid, stitle, group)
+
+def resolve_step(staxid, step_of):
+    # Walk up from the subject taxon to the first node of the target lineage.
+    # A subject annotated directly on a lineage node that has children is never
+    # reached by the iterative search (its taxon list only holds the children).
+    taxid = staxid
+    while taxid is not None:
+        if taxid in step_of:
+            if taxid == staxid and utils.CHILDREN.get(str(taxid)):
+                return None
+            return step_of[taxid]
+        parent = utils.PARENT.get(str(taxid))
+        if parent == taxid:
+            return None
+        taxid = parent
+    return None
+
+def passes_filters(h, min_pid=0, min_qcov=0, min_scov=0, min_bits=MIN_BITS):
+    if h.qlen <= 0 or h.slen <= 0:
+        return False
+    qcov = h.alen / h.qlen
+    scov = h.alen / h.slen
+    if h.pident < min_pid or qcov < min_qcov or scov < min_scov or h.bits < min_bits:
+        return False
+    h.qcov = qcov
+    h.scov = scov
+    return True
+
+def keep_best(heaps, h, key, order, top=3):
+    # Bounded max-heap per query on (key, arrival order): heap[0] is the worst
+    # kept hit, a new hit only replaces it when its key is strictly better.
+    h.key = key
+    entry = (-key[0], -key[1], -key[2], -order, h)
+    heap = heaps.get(h.qseqid)
+    if heap is None:
+        heaps[h.qseqid] = [entry]
+    elif len(heap) < top:
+        heapq.heappush(heap, entry)
+    elif entry > heap[0]:
+        heapq.heapreplace(heap, entry)
+    else:
+        return
+    # Only kept hits are interned: a subject kept for many queries shares its strings
+    h.sseqid = sys.intern(h.sseqid)
+    h.stitle = sys.intern(h.stitle)
+
+def sorted_best(heaps):
+    return {q: [entry[-1] for entry in sorted(heap, reverse=True)] for q, heap in heaps.items()}
+
+def select_best_by_step(hits, lineage_groups, excluded_tax=frozenset(), **filters):
+    # Single-pass search: each hit is assigned to its taxonomic step first and
+    # the best hits are kept per (step, query), as the iterative loop would.
+    lineage_groups = [ancestor(*group) for group in lineage_groups]
+    step_of = {group[0]: step for step, group in enumerate(lineage_groups, start=1)}
+    resolved = {}
+    heaps_by_step = {}
+    for order, h in enumerate(hits):
+        staxid = h.staxid
+        if staxid not in resolved:
+            resolved[staxid] = resolve_step(staxid, step_of)
+        step = resolved[staxid]
+        if step is None:
             continue
-        qcov = h["alen"] / h["qlen"]
-        scov = h["alen"] / h["slen"]
-        if h["pident"] < min_pid or qcov < min_qcov or scov < min_scov or h["bits"] < min_bits:
+        group = lineage_groups[step - 1]
+        if group[0] in excluded_tax or not passes_filters(h, **filters):
+            continue
+        h.ancestor = group
+        keep_best(heaps_by_step.setdefault(step, {}), h, (step, -h.bits, -h.pident), order)
+    return {step: sorted_best(heaps) for step, heaps in heaps_by_step.items()}
+
+def select_best_by_priority(hits, target_taxid, step,
+                            min_pid=0, min_qcov=0, min_scov=0, min_bits=MIN_BITS):
+    heaps = {}
+    for order, h in enumerate(hits):
+        if not passes_filters(h, min_pid, min_qcov, min_scov, min_bits):
             continue
-        h["_qcov"] = qcov
-        h["_scov"] = scov
-        
         # Prioriry: Highest bitscore, then higher identity
-        key = (step, -h["bits"], -h["pident"])
-        h["_key"] = key
-        q = h["qseqid"]
-
-        if q not in best_per_query:
-            best_per_query[q] = []
-        if len(best_per_query[q]) < 3:
-            best_per_query[q].append(h)
-        elif key < best_per_query[q][-1]["_key"]:
-            best_per_query[q][-1] = h
-            best_per_query[q].sort(key=lambda x: x["_key"])
-            
-    return best_per_query
\ No newline at end of file
+        keep_best(heaps, h, (step, -h.bits, -h.pident), order)
+    return sorted_best(heaps)
+
+def timed_selection(metrics, select, hits, *args):
+    # CPU time of the selection itself: total time minus the parsing done while it consumes the hits
+    if metrics is None:
+        return select(hits, *args)
+    parse_before = metrics.get('parse_time', 0.0)
+    start = time.process_time()
+    best = select(hits, *args)
+    metrics['selection_time'] = (
+        metrics.get('selection_time', 0.0) + time.process_time() - start
+        - (metrics.get('parse_time', 0.0) - parse_before)
+    )
+    return best
+
+def search(run_id, query_fasta, fasta_index, ids, tmp_fasta, taxonlist, group, target_taxid, step, mode="more-sensitive", metrics=None,
+           n_chunks=1, partial=None, on_chunk=None, **diamond_args):
+    # Search the given query ids (whole FASTA when they are all of them) and select their best hits.
+    # With n_chunks > 1 the ids are searched in residue-balanced chunks and each
+    # finished chunk is reported to on_chunk; partial holds, per mode, the chunks
+    # already finished by an interrupted attempt at this step.
+    best = {}
+    done = (partial or {}).get(mode)
+    if done:
+        best.update(done['best'])
+        ids = set(ids) - done['ids']
+    if not ids:
+        return best
+    if len(ids) == len(fasta_index):
+        records = fasta_index
+    else:
+        records = [entry for entry in fasta_index if entry[0] in ids]
+    for chunk in utils.balance_records(records, n_chunks):
+        if len(chunk) == len(fasta_index):
+            chunk_fasta = query_fasta
+        else:
+            chunk_fasta = tmp_fasta
+            utils.copy_fasta_records(query_fasta, chunk, chunk_fasta)
+        hits = run_diamond(run_id, chunk_fasta, taxonlist, group, mode=mode, metrics=metrics, **diamond_args)
+        chunk_best = timed_selection(metrics, select_best_by_priority, hits, target_taxid, step)
+        if chunk_fasta != query_fasta:
+            try:
+                os.remove(chunk_fasta)
+            except OSError:
+                pass
+        best.update(chunk_best)
+        if on_chunk is not None:
+            on_chunk(mode, {entry[0] for entry in chunk}, chunk_best)
+    return best
+
+def cascade_search(run_id, query_fasta, fasta_index, ids, tmp_fasta, taxonlist, group, target_taxid, step,
+                   fast_mode="fast", sensitive_mode="more-sensitive", margin=20.0, **diamond_args):
+    # Fast mode first; queries whose best hit clears MIN_BITS by the margin are
+    # accepted, only the others are searched again with the sensitive mode.
+    best = search(run_id, query_fasta, fasta_index, ids, tmp_fasta, taxonlist, group, target_taxid, step, mode=fast_mode, **diamond_args)
+    accepted = {q for q, hits in best.items() if hits[0].bits >= MIN_BITS + margin}
+    remaining = set(ids) - accepted
+    resolved_sensitive = 0
+    if remaining:
+        sensitive = search(run_id, query_fasta, fasta_index, remaining, tmp_fasta, taxonlist, group, target_taxid, step, mode=sensitive_mode, **diamond_args)
+        resolved_sensitive = len(sensitive)
+        best.update(sensitive)
+    return best, len(accepted), resolved_sensitive
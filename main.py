@@ -1,13 +1,18 @@
 import argparse
-import os, re
+import math
+import os, sys
 import shutil
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 import time
-import copy
 from datetime import datetime
-import utils, homology, excel, stats
+import utils, homology, excel, stats, hit_cache, scheduler
+
+if len(sys.argv) > 1 and sys.argv[1] in ("shard", "shard-run", "merge"):
+    import sharding
+    sharding.main(sys.argv[1:])
+    exit()
+if len(sys.argv) > 1 and sys.argv[1] == "batch":
+    scheduler.main(sys.argv[2:])
+    exit()
 
 parser = argparse.ArgumentParser(description="Brownaming: Propagating Sequence Names for Similar Organisms")
 parser.add_argument('-p', '--proteins', help='FASTA file of query proteins')
@@ -20,7 +25,26 @@ parser.add_argument('--local-db', help='Path to local database (optional if defi
 parser.add_argument('--working-dir', help='Final output directory (optional, run still executes in runs/YYYY-MM-DD-HH-MM-TAXID)')
 parser.add_argument('--run-id', help='Custom run ID (optional, default: timestamp-taxid)')
 parser.add_argument('--resume', help='Resume a previous run using the run ID')
+parser.add_argument('--single-pass', action='store_true', help='Run a single DIAMOND search against the widest taxon and resolve taxonomic steps from the hits')
+parser.add_argument('--single-pass-targets', type=int, default=500, help='Maximum number of target sequences per query in single-pass mode (default: 500)')
+parser.add_argument('--cascade', action='store_true', help='At each step, search with a fast DIAMOND mode first and re-search with --more-sensitive only the sequences without a confident hit')
+parser.add_argument('--cascade-mode', default='fast', choices=['fast', 'mid-sensitive', 'sensitive'], help='DIAMOND mode of the first cascade tier (default: fast)')
+parser.add_argument('--cascade-margin', type=float, default=20.0, help=f'Bitscore margin above the {homology.MIN_BITS:g} bits threshold required to accept a first-tier hit (default: 20)')
+parser.add_argument('--hit-cache', action='store_true', help='Reuse hits of identical sequences searched by previous runs (cache stored in the local database directory)')
+parser.add_argument('--block-size', type=float, default=None, help='DIAMOND --block-size in billions of letters (default: chosen at each step from the available memory)')
+parser.add_argument('--index-chunks', type=int, default=None, help='DIAMOND --index-chunks (default: chosen at each step from the available memory)')
+parser.add_argument('--table-format', default='xlsx', choices=excel.TABLE_FORMATS, help='Format of the result tables: one Excel workbook, or TSV / Parquet files (default: xlsx)')
+parser.add_argument('--chunk-minutes', type=float, default=0, help='Split each step into DIAMOND chunks predicted to take about this many minutes, so that an interrupted step resumes with its unfinished chunks (default: 0, one search per step)')
+parser.add_argument('--compress-fasta', action='store_true', help='Write the renamed FASTA gzip-compressed (<name>_brownamed.fasta.gz)')
+parser.add_argument('--compress-checkpoints', action='store_true', help='Compress the checkpoint journal (smaller run directory, slightly more CPU per step)')
+parser.add_argument('--hit-cache-size', type=int, default=hit_cache.DEFAULT_MAX_MB, help=f'Maximum size of the hit cache in MB (default: {hit_cache.DEFAULT_MAX_MB})')
 args = parser.parse_args()
+if not args.resume:
+    excel.check_table_format(args.table_format)
+    if args.single_pass and (args.cascade or args.hit_cache):
+        # One search for all steps: no per-step tiers to cascade, no per-step hits to cache
+        print("[ERROR] --single-pass cannot be combined with --cascade or --hit-cache")
+        exit(1)
 
 
 def error_exit(message, run_id=None):
@@ -45,7 +69,7 @@ if args.resume:
     if not os.path.isdir(run_working_dir):
         error_exit("Run directory not found in Brownaming/runs.", RUN_ID)
 
-    state_args, state = utils.load_state(RUN_ID)
+    state_args, state = utils.load_state(RUN_ID, repair=True)
     if not state_args:
         error_exit("Could not load resume state from state_args.json.", RUN_ID)
 
@@ -56,13 +80,27 @@ if args.resume:
     args.swissprot_only = state_args.get('swissprot_only', False)
     args.local_db = state_args.get('local_db')
     args.threads = state_args.get('threads')
+    args.single_pass = state_args.get('single_pass', False)
+    args.single_pass_targets = state_args.get('single_pass_targets', 500)
+    args.hit_cache = state_args.get('hit_cache', False)
+    args.cascade = state_args.get('cascade', False)
+    args.cascade_mode = state_args.get('cascade_mode', 'fast')
+    args.cascade_margin = state_args.get('cascade_margin', 20.0)
+    args.hit_cache_size = state_args.get('hit_cache_size', hit_cache.DEFAULT_MAX_MB)
+    args.block_size = state_args.get('block_size')
+    args.index_chunks = state_args.get('index_chunks')
+    args.table_format = state_args.get('table_format', 'xlsx')
+    excel.check_table_format(args.table_format)
+    args.compress_checkpoints = state_args.get('compress_checkpoints', False)
+    args.compress_fasta = state_args.get('compress_fasta', False)
+    args.chunk_minutes = state_args.get('chunk_minutes', 0)
     final_output_dir = state_args.get('working_dir')
 
     logger = utils.setup_logger(RUN_ID)
     logger.info(f"Resuming Brownaming with run ID: {RUN_ID}")
 
     if state:
-        assigned = state['assigned']
+        assigned = homology.as_hits(state['assigned'])
         pending = state['pending']
         curr_tax = state['curr_tax']
         prev_group = state['prev_group']
@@ -73,6 +111,7 @@ if args.resume:
         query_ids = state['query_ids']
         estimated_runtime_list = state['estimated_runtime_list']
         dbsizes = state['dbsizes']
+        partial_step = state.get('partial_step', {})
         saved_args = state.get('args')
         if saved_args:
             args.ex_tax = getattr(saved_args, 'ex_tax', args.ex_tax)
@@ -104,19 +143,16 @@ else:
         print(f"[INFO] Final output directory requested for run_id {RUN_ID}: {final_output_dir}")
 
     utils.create_run(RUN_ID)
+    if utils.reset_run_state(RUN_ID):
+        print(f"[WARNING] Run ID {RUN_ID} was already used, its checkpoints are discarded (use --resume {RUN_ID} to continue it)")
     utils.save_state_args(args, RUN_ID)
 
     logger = utils.setup_logger(RUN_ID)
     logger.info(f"Starting the Brownaming process with run ID: {RUN_ID}")
 
 working_directory = utils.working_dir(RUN_ID)
-output_fasta_file = working_directory + '/' + os.path.basename(query_fasta).replace('.fasta', '_brownamed.fasta').replace('.faa', '_brownamed.fasta')
-output_stats_file = working_directory + '/' + os.path.basename(query_fasta).replace('.fasta', '_brownaming_stats.png').replace('.faa', '_brownaming_stats.png')
-output_excel_file = working_directory + '/' + os.path.basename(query_fasta).replace('.fasta', '_diamond_results.xlsx').replace('.faa', '_diamond_results.xlsx')
-state_file = os.path.join(working_directory, f"state.pkl")
-# save_interval = 15 * 60
-save_interval = 5
-next_save = save_interval
+output_fasta_file, output_stats_file, output_excel_file = utils.output_files(query_fasta, working_directory)
+journal_file = utils.journal_path(RUN_ID)
 
 if args.local_db:
     utils.LOCAL_DB_PATH = args.local_db
@@ -140,15 +176,21 @@ utils.TAXID_TO_NAME = utils.set_taxid_to_scientificname()
 taxid2name = utils.get_taxid_to_scientificname()
 
 utils.TAXID_TO_DBSIZE = utils.set_taxid_to_dbsize()
+if not utils.TAXID_TO_DBSIZE:
+    logger.warning("taxid2dbsize.json not found in the local database, database sizes will be requested from rest.uniprot.org")
+
+excluded_tax = utils.excluded_taxa(args.ex_tax)
 
-excluded_tax = []
-if args.ex_tax:
-    for tax in args.ex_tax:
-        excluded_tax += utils.get_children(tax)
+fasta_index = utils.get_fasta_index(query_fasta, RUN_ID)
+search_mode = f"cascade:{args.cascade_mode}" if args.cascade else "more-sensitive"
 
 if not args.resume or not state:
-    query_ids = [rec.id for rec in SeqIO.parse(query_fasta, 'fasta')]
-    estimated_runtime, estimated_runtime_list, dbsizes = utils.estimate_runtime(len(query_ids), target_taxid, last_tax=args.last_tax, swissprot_only=args.swissprot_only)
+    query_ids = [entry[0] for entry in fasta_index]
+    estimated_runtime, estimated_runtime_list, dbsizes = utils.estimate_runtime(
+        len(query_ids), target_taxid, last_tax=args.last_tax, swissprot_only=args.swissprot_only,
+        residues=sum(entry[3] for entry in fasta_index), threads=args.threads,
+        mode=search_mode
+    )
     estimated_hours = int(estimated_runtime // 60)
     estimated_minutes = int(estimated_runtime % 60)
     logger.info(f"Estimated total runtime: {estimated_hours:02d}:{estimated_minutes:02d} (hh:mm)")
@@ -160,61 +202,206 @@ if not args.resume or not state:
     step = 0
     stats_data = {}
     timer_start = time.time()
+    partial_step = {}
+
+seq_hash = {entry[0]: entry[4] for entry in fasta_index}
+seq_residues = {entry[0]: entry[3] for entry in fasta_index}
+
+def diamond_memory_settings(dbsize, residues, threads):
+    # Values given on the command line win over the ones derived from the available
+    # memory, of which a batch step only gets the share of its granted cores
+    block_size, index_chunks = args.block_size, args.index_chunks
+    if block_size is None or index_chunks is None:
+        available = utils.available_memory()
+        if available:
+            available = int(available * scheduler.memory_share(threads))
+        auto_block_size, auto_index_chunks = utils.diamond_memory_settings(dbsize, residues, threads, available)
+        block_size = auto_block_size if block_size is None else block_size
+        index_chunks = auto_index_chunks if index_chunks is None else index_chunks
+    return block_size, index_chunks
+
+if not os.path.exists(journal_file) or not os.path.getsize(journal_file):
+    utils.start_journal(journal_file, utils.journal_header(
+        query_fasta, target_taxid, query_ids, estimated_runtime_list, dbsizes, curr_tax, prev_group,
+        step, assigned, None if len(pending) == len(query_ids) else pending, stats_data, time.time() - timer_start
+    ), compress=args.compress_checkpoints)
+
+def record_chunk(mode, ids, chunk_best):
+    utils.append_journal(journal_file, utils.journal_chunk(step, mode, ids, chunk_best), compress=args.compress_checkpoints)
+
+best_by_step = {}
+if args.single_pass and curr_tax is not None and pending:
+    lineage_groups = [
+        (tax, taxid2name.get(str(tax), "unknown"), rank.get(str(tax), 'unknown'))
+        for tax in utils.get_lineage(target_taxid, last_tax=args.last_tax)
+    ]
+    widest = lineage_groups[-1]
+    single_fasta = os.path.join(working_directory, f".pending_{os.getpid()}_single.fasta")
+    duplicates = utils.collapse_duplicates(pending, seq_hash)
+    if len(duplicates) == len(query_ids):
+        single_fasta = query_fasta
+    else:
+        utils.write_pending_fasta(query_fasta, duplicates, single_fasta, fasta_index)
+    single_start = time.time()
+    single_metrics = {}
+    logger.info(
+        f"Single-pass search among {widest[1]} ({widest[0]} ; {widest[2]}) "
+        f"with {len(pending)} pending sequences ({len(duplicates)} distinct)..."
+    )
+    core_wait = time.time()
+    core_slot, threads = scheduler.acquire_cores(args.threads, sum(estimated_runtime_list), f"{RUN_ID} single-pass")
+    single_metrics['core_wait'] = time.time() - core_wait
+    block_size, index_chunks = diamond_memory_settings(sum(dbsizes), sum(seq_residues[q] for q in duplicates), threads)
+    logger.info(f"Single-pass DIAMOND --block-size {block_size or 'default'} --index-chunks {index_chunks or 'default'}")
+    hits = homology.run_diamond(
+        RUN_ID,
+        single_fasta,
+        homology.build_taxon_list(widest[0], None, swissprot_only=args.swissprot_only, ex_tax=args.ex_tax),
+        widest,
+        threads=threads,
+        max_targets=args.single_pass_targets,
+        mode="more-sensitive",
+        excluded_tax=excluded_tax,
+        swissprot_only=args.swissprot_only,
+        metrics=single_metrics,
+        block_size=block_size,
+        index_chunks=index_chunks
+    )
+    best_by_step = {
+        step_number: homology.expand_duplicates(best, duplicates)
+        for step_number, best in homology.timed_selection(
+            single_metrics, homology.select_best_by_step, hits, lineage_groups, excluded_tax
+        ).items()
+    }
+    scheduler.release_cores(core_slot)
+    # Recorded as step 0: one search over the whole lineage, with more targets
+    utils.append_metrics(RUN_ID, utils.metrics_record(
+        RUN_ID, 0, widest[0], duplicates, seq_residues, sum(dbsizes),
+        threads, "single-pass:more-sensitive", args.swissprot_only, time.time() - single_start, single_metrics
+    ))
+    if single_fasta != query_fasta:
+        try:
+            os.remove(single_fasta)
+        except OSError:
+            pass
+
+hit_cache_db = None
+if args.hit_cache and not args.single_pass:
+    hit_cache_db = hit_cache.HitCache(
+        hit_cache.cache_path(utils.LOCAL_DB_PATH),
+        utils.get_db_dmnd(args.swissprot_only),
+        args.swissprot_only,
+        f"cascade:{args.cascade_mode}+{args.cascade_margin}:more-sensitive:k50" if args.cascade else "more-sensitive:k50",
+        max_mb=args.hit_cache_size
+    )
 
 while curr_tax is not None and pending:
     step += 1
+    step_start = time.time()
+    searched_ids = None
+    step_metrics = {}
+    best = {}
     tmp_fasta = os.path.join(working_directory, f".pending_{os.getpid()}_{step}.fasta")
     curr_tax_name = taxid2name.get(str(curr_tax), "unknown")
     curr_tax_rank = rank.get(str(curr_tax), 'unknown')
-    
-    if len(pending) == len(query_ids):
-        tmp_fasta = query_fasta
-        n_written = len(pending)
-    else:
-        n_written = utils.write_pending_fasta(query_fasta, pending, tmp_fasta)
+    n_pending = len(pending)
 
-    if n_written > 0:
-        logger.info(
-            f"Step {step}: Searching among {dbsizes[step-1]} sequences of {curr_tax_name} "
-            f"({curr_tax} ; {curr_tax_rank}) with {n_written} pending sequences "
-            f"(estimated runtime={estimated_runtime_list[step-1]:.2f} minutes)..."
-        )
-        stats_data[f"Step {step}"] = {
-            'dbsize': dbsizes[step-1],
-            'taxon_name': curr_tax_name,
-            'taxon_id': curr_tax,
-            'rank': curr_tax_rank,
-            'nb_query': n_written,
-            'estimated_runtime': f"{estimated_runtime_list[step-1]:.2f}"
-        }
-        input_taxon_list = homology.build_taxon_list(curr_tax, prev_group)
-        if not input_taxon_list:
-            logger.info(f"Step {step}: Subject database empty, continue to upper taxon")
-            stats_data[f"Step {step}"]['prots_with_hit'] = stats_data.get(f"Step {step-1}", {}).get('prots_with_hit', 0)
+    logger.info(
+        f"Step {step}: Searching among {dbsizes[step-1]} sequences of {curr_tax_name} "
+        f"({curr_tax} ; {curr_tax_rank}) with {n_pending} pending sequences "
+        f"(estimated runtime={estimated_runtime_list[step-1]:.2f} minutes)..."
+    )
+    stats_data[f"Step {step}"] = {
+        'dbsize': dbsizes[step-1],
+        'taxon_name': curr_tax_name,
+        'taxon_id': curr_tax,
+        'rank': curr_tax_rank,
+        'nb_query': n_pending,
+        'estimated_runtime': f"{estimated_runtime_list[step-1]:.2f}"
+    }
+    input_taxon_list = homology.build_taxon_list(curr_tax, prev_group, swissprot_only=args.swissprot_only, ex_tax=args.ex_tax)
+    if not input_taxon_list:
+        logger.info(f"Step {step}: Subject database empty, continue to upper taxon")
+        stats_data[f"Step {step}"]['prots_with_hit'] = stats_data.get(f"Step {step-1}", {}).get('prots_with_hit', 0)
+    else:
+        group = (curr_tax, curr_tax_name, curr_tax_rank)
+        if args.single_pass:
+            best = {q: value for q, value in best_by_step.pop(step, {}).items() if q in pending}
         else:
-            hits = homology.run_diamond(
-                RUN_ID,
-                tmp_fasta,
-                input_taxon_list,
-                (curr_tax, curr_tax_name, curr_tax_rank),
-                threads=args.threads,
-                max_targets=50,
-                mode="more-sensitive",
-                excluded_tax=excluded_tax,
-                swissprot_only=args.swissprot_only
-            )
-            best = homology.select_best_by_priority(hits, target_taxid, step)
-            assigned.update(best)
-            logger.info(f"Step {step}: Found a satisfying hit for {len(assigned)} proteins")
-            stats_data[f"Step {step}"]['prots_with_hit'] = len(assigned)
-            pending -= {key for key, value in best.items() if len(value) < 3}
-
-        if tmp_fasta != query_fasta:
-            try:
-                os.remove(tmp_fasta)
-            except OSError:
-                pass
-
+            best = {}
+            search_ids = pending
+            if hit_cache_db is not None:
+                cache_key = hit_cache.step_key(curr_tax, input_taxon_list, args.ex_tax)
+                cached = hit_cache_db.lookup([seq_hash[q] for q in pending], cache_key)
+                search_ids = {q for q in pending if seq_hash[q] not in cached}
+                for q in pending - search_ids:
+                    if cached[seq_hash[q]]:
+                        best[q] = hit_cache.from_rows(cached[seq_hash[q]], q, group, step)
+                logger.info(f"Step {step}: {n_pending - len(search_ids)} sequences found in the hit cache")
+
+            if search_ids:
+                duplicates = utils.collapse_duplicates(search_ids, seq_hash)
+                searched_ids = duplicates
+                if len(duplicates) < len(search_ids):
+                    logger.info(f"Step {step}: {len(search_ids) - len(duplicates)} duplicate sequences collapsed, searching {len(duplicates)} distinct sequences")
+                core_wait = time.time()
+                core_slot, threads = scheduler.acquire_cores(args.threads, estimated_runtime_list[step-1], f"{RUN_ID} step {step}")
+                step_metrics['core_wait'] = time.time() - core_wait
+                block_size, index_chunks = diamond_memory_settings(dbsizes[step-1], sum(seq_residues[q] for q in duplicates), threads)
+                logger.info(f"Step {step}: DIAMOND --block-size {block_size or 'default'} --index-chunks {index_chunks or 'default'}")
+                n_chunks = 1
+                if args.chunk_minutes > 0:
+                    # Only the sequences not searched before an interruption are split
+                    done = partial_step.get(args.cascade_mode if args.cascade else "more-sensitive")
+                    to_search = len(duplicates.keys() - done['ids']) if done else len(duplicates)
+                    predicted = estimated_runtime_list[step-1] * to_search / len(query_ids)
+                    n_chunks = max(1, min(max(to_search, 1), math.ceil(predicted / args.chunk_minutes)))
+                if partial_step:
+                    logger.info(f"Step {step}: resuming with {sum(len(done['ids']) for done in partial_step.values())} sequences searched before the interruption")
+                diamond_args = dict(
+                    threads=threads,
+                    n_chunks=n_chunks,
+                    partial=partial_step,
+                    on_chunk=record_chunk if n_chunks > 1 or partial_step else None,
+                    max_targets=50,
+                    excluded_tax=excluded_tax,
+                    swissprot_only=args.swissprot_only,
+                    metrics=step_metrics,
+                    block_size=block_size,
+                    index_chunks=index_chunks
+                )
+                if args.cascade:
+                    searched, n_fast, n_sensitive = homology.cascade_search(
+                        RUN_ID, query_fasta, fasta_index, duplicates, tmp_fasta, input_taxon_list, group, target_taxid, step,
+                        fast_mode=args.cascade_mode, sensitive_mode="more-sensitive", margin=args.cascade_margin,
+                        **diamond_args
+                    )
+                    logger.info(
+                        f"Step {step}: Cascade resolved {n_fast} sequences with --{args.cascade_mode} "
+                        f"and {n_sensitive} of the {len(duplicates) - n_fast} remaining with --more-sensitive"
+                    )
+                    stats_data[f"Step {step}"]['cascade_fast'] = n_fast
+                    stats_data[f"Step {step}"]['cascade_sensitive'] = n_sensitive
+                else:
+                    searched = homology.search(
+                        RUN_ID, query_fasta, fasta_index, duplicates, tmp_fasta, input_taxon_list, group, target_taxid, step,
+                        mode="more-sensitive", **diamond_args
+                    )
+                scheduler.release_cores(core_slot)
+                if hit_cache_db is not None:
+                    hit_cache_db.store(
+                        {seq_hash[q]: hit_cache.to_rows(searched.get(q, [])) for q in duplicates},
+                        cache_key
+                    )
+                best.update(homology.expand_duplicates(searched, duplicates))
+        assigned.update(best)
+        logger.info(f"Step {step}: Found a satisfying hit for {len(assigned)} proteins")
+        stats_data[f"Step {step}"]['prots_with_hit'] = len(assigned)
+    resolved = {key for key, value in best.items() if len(value) < 3}
+    partial_step = {}
+    pending -= resolved
+
+    curr_tax_id = curr_tax
     prev_group = curr_tax
     if curr_tax == args.last_tax or curr_tax == 131567:
         curr_tax = None
@@ -225,77 +412,33 @@ while curr_tax is not None and pending:
     logger.info(f"Elapsed time: {elapsed/60:.2f} minutes")
     stats_data[f"Step {step}"]['elapsed_time'] = f"{elapsed/60:.2f}"
 
-    if elapsed >= next_save:
-        utils.save_state(
-            state_file,
-            assigned,
-            pending,
-            curr_tax,
-            prev_group,
-            step,
-            stats_data,
-            elapsed,
-            query_fasta,
-            target_taxid,
-            query_ids,
-            estimated_runtime_list,
-            dbsizes,
-            args
+    if searched_ids:
+        step_seconds = time.time() - step_start
+        stats_data[f"Step {step}"]['search_time'] = f"{(step_seconds - step_metrics.get('core_wait', 0.0))/60:.2f}"
+        utils.append_metrics(RUN_ID, utils.metrics_record(
+            RUN_ID, step, curr_tax_id, searched_ids, seq_residues, dbsizes[step-1],
+            threads, search_mode, args.swissprot_only, step_seconds, step_metrics
+        ))
+
+    if curr_tax is not None and pending:
+        ratio, remaining = utils.corrected_eta(stats_data, estimated_runtime_list, step)
+        logger.info(
+            f"Corrected remaining runtime: {int(remaining // 60):02d}:{int(remaining % 60):02d} (hh:mm) "
+            f"(observed/predicted time ratio: {ratio:.2f})"
         )
-        next_save = ((elapsed // save_interval) + 1) * save_interval
+
+    utils.append_journal(journal_file, utils.journal_step(
+        step, best, resolved, curr_tax, prev_group, stats_data[f"Step {step}"], elapsed
+    ), compress=args.compress_checkpoints)
+
+if hit_cache_db is not None:
+    hit_cache_db.close()
 
 stats.generate_combined_figure(stats_data, output_file=output_stats_file)
 
-output_data = {
-    "Query accession": [],
-    "Subject accession": [],
-    "Subject description": [],
-    "Subject species (taxid)": [],
-    "Subject species (name)": [],
-    "Gene Name": [],
-    "Bitscore": [],
-    "Evalue": [],
-    "Identity (%)": [],
-    "Similarity (%)": [],
-    "Query coverage (%)": [],
-    "Subject coverage (%)": [],
-    "Common ancestor (rank)": [],
-    "Common ancestor (taxID)": [],
-    "Common ancestor (name)": [],
-    "Hit found": []
-}
-output_top3 = copy.deepcopy(output_data)
-
-for qid in query_ids:
-    if qid in assigned:
-        output_data = excel.add_hit(output_data, assigned[qid][0])
-        for hit in assigned[qid]:
-            output_top3 = excel.add_hit(output_top3, hit)
-    else:
-        output_data = excel.add_no_hit(output_data, qid)
-        output_top3 = excel.add_no_hit(output_top3, qid)
-
-excel.write_excel(output_data, output_excel_file)
-excel.add_sheet(output_top3, output_excel_file, "Top3 hits")
-
-output_records = []
-for record in SeqIO.parse(query_fasta, "fasta"):
-    new_description = "Uncharacterized protein"
-    if record.id in assigned:
-        re_description_search = re.findall(r" .* OS=", assigned[record.id][0].get("stitle", ""))
-        if len(re_description_search) != 0:
-            record_description = re_description_search[0][1:-4]
-            new_description = f"{record_description} FROM {taxid2name.get(str(assigned[record.id][0].get('staxid')), '')}"
-
-    rec = SeqRecord(
-        Seq(str(record.seq).upper()),
-        id=record.id,
-        description=new_description
-    )
-    output_records.append(rec)
+excel.write_results(query_ids, assigned, output_excel_file, table_format=args.table_format)
 
-with open(output_fasta_file, "w") as f:
-    SeqIO.write(output_records, f, "fasta")
+utils.write_brownamed_fasta(query_fasta, assigned, output_fasta_file, compress=args.compress_fasta)
 
 if final_output_dir:
     internal_run_dir = utils.working_dir(RUN_ID)
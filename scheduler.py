@@ -0,0 +1,272 @@
+import argparse
+import fcntl
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import utils, excel
+
+# Local batch mode: runs many Brownaming analyses on one node under a global
+# core budget. Every run is a normal main.py process with its own runs/<run_id>
+# directory (and resume); their DIAMOND steps take cores from a ledger file
+# shared through BROWNAMING_CORE_LEDGER. The step with the longest predicted
+# runtime waiting for cores keeps a reservation, shorter steps are backfilled
+# into the free cores when they are predicted to finish before it can start.
+LEDGER_ENV = "BROWNAMING_CORE_LEDGER"
+LEDGER_FILE = "cores.json"
+BATCH_FILE = "batch.json"
+POLL_INTERVAL = 2
+FORBIDDEN_RUN_ARGS = ('-p', '--proteins', '-s', '--species', '--run-id', '--resume')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _update_ledger(path, update):
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            content = f.read()
+            ledger = json.loads(content) if content else {'budget': os.cpu_count() or 1, 'holders': {}, 'waiting': {}}
+            # Entries of runs that were killed
+            for section in ('holders', 'waiting'):
+                ledger[section] = {key: e for key, e in ledger[section].items() if _alive(e['pid'])}
+            result = update(ledger)
+            f.seek(0)
+            f.truncate()
+            json.dump(ledger, f)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+def _may_start(ledger, key, now):
+    request = ledger['waiting'][key]
+    free = ledger['budget'] - sum(e['cores'] for e in ledger['holders'].values())
+    if request['cores'] > free:
+        return False
+    head_key = max(ledger['waiting'], key=lambda k: (ledger['waiting'][k]['predicted'], -ledger['waiting'][k]['since']))
+    if head_key == key:
+        return True
+    head = ledger['waiting'][head_key]
+    if head['cores'] <= free - request['cores']:
+        return True
+    # Earliest time at which the head request gets its cores, from the predicted end of the running steps
+    shadow = None
+    available = free
+    for end, cores in sorted((e['end'], e['cores']) for e in ledger['holders'].values()):
+        available += cores
+        if available >= head['cores']:
+            shadow = end
+            break
+    return shadow is not None and now + request['predicted'] * 60 <= shadow
+
+def acquire_cores(threads, predicted_minutes, label):
+    # Blocks until the ledger grants the cores; without a ledger, runs as before
+    path = os.environ.get(LEDGER_ENV)
+    threads = threads or os.cpu_count() or 1
+    if not path:
+        return None, threads
+    key = f"{os.getpid()}-{time.time_ns()}"
+
+    def register(ledger):
+        cores = min(threads, ledger['budget'])
+        ledger['waiting'][key] = {'pid': os.getpid(), 'cores': cores, 'predicted': float(predicted_minutes), 'since': time.time(), 'label': label}
+        return cores
+
+    def try_start(ledger):
+        now = time.time()
+        if key not in ledger['waiting']:
+            register(ledger)
+        if not _may_start(ledger, key, now):
+            return False
+        request = ledger['waiting'].pop(key)
+        request['end'] = now + request['predicted'] * 60
+        ledger['holders'][key] = request
+        return True
+
+    cores = _update_ledger(path, register)
+    start = time.time()
+    while not _update_ledger(path, try_start):
+        time.sleep(POLL_INTERVAL)
+    waited = time.time() - start
+    if waited >= POLL_INTERVAL:
+        print(f"[INFO] {label}: waited {waited/60:.2f} minutes for {cores} cores", flush=True)
+    return key, cores
+
+def memory_share(cores):
+    # Concurrent steps of a batch split the node memory like the core budget
+    path = os.environ.get(LEDGER_ENV)
+    if not path:
+        return 1.0
+    budget = _update_ledger(path, lambda ledger: ledger['budget'])
+    return min(1.0, cores / budget)
+
+def release_cores(key):
+    path = os.environ.get(LEDGER_ENV)
+    if path and key:
+        _update_ledger(path, lambda ledger: ledger['holders'].pop(key, None))
+
+
+def read_manifest(path):
+    # One run per line: FASTA TAXID [main.py options...]
+    runs = []
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) < 2 or not fields[1].isdigit():
+                print(f"[ERROR] {path}:{line_number}: expected 'FASTA TAXID [options]'")
+                exit(1)
+            for arg in fields[2:]:
+                if arg.split('=')[0] in FORBIDDEN_RUN_ARGS:
+                    print(f"[ERROR] {path}:{line_number}: {arg} is set by the batch and cannot be used in the manifest")
+                    exit(1)
+            excel.check_run_args(fields[2:])
+            runs.append({'fasta': os.path.abspath(fields[0]), 'species': int(fields[1]), 'run_args': fields[2:]})
+    return runs
+
+def predict_run(run):
+    # Same estimate as main.py prints at start, used to launch the longest runs first
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--last-tax', type=int, default=None)
+    parser.add_argument('--swissprot-only', action='store_true')
+    parser.add_argument('--threads', type=int, default=None)
+    options, _ = parser.parse_known_args(run['run_args'])
+    index = utils.build_fasta_index(run['fasta'])
+    total, _, _ = utils.estimate_runtime(
+        len(index), run['species'], last_tax=options.last_tax, swissprot_only=options.swissprot_only,
+        residues=sum(entry[3] for entry in index), threads=options.threads
+    )
+    return total
+
+def final_dir(run):
+    # Where main.py leaves a completed run: its --working-dir, or runs/<run_id>
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--working-dir', default=None)
+    options, _ = parser.parse_known_args(run['run_args'])
+    return os.path.abspath(options.working_dir) if options.working_dir else utils.working_dir(run['run_id'])
+
+_batch_lock = threading.Lock()
+
+def save_batch(batch, batch_dir, entry=None, **fields):
+    # Runs finish in concurrent threads: their entry is updated under the lock
+    with _batch_lock:
+        if entry is not None:
+            entry.update(fields)
+        with open(os.path.join(batch_dir, BATCH_FILE), 'w') as f:
+            json.dump(batch, f, indent=4)
+
+def run_command(run, threads):
+    main_py = os.path.join(utils.script_dir(), 'main.py')
+    if os.path.exists(os.path.join(utils.working_dir(run['run_id']), 'state_args.json')):
+        return [main_py, '--resume', run['run_id']]
+    run_args = list(run['run_args'])
+    if '--threads' not in run_args:
+        run_args += ['--threads', str(threads)]
+    return [main_py, '-p', run['fasta'], '-s', str(run['species']), '--run-id', run['run_id'], *run_args]
+
+def run_batch(batch, batch_dir, jobs, threads, runs=None):
+    # Completed runs are recorded in batch.json with their final directory: a
+    # run moved to its --working-dir is no longer found in runs/<run_id>
+    ledger_path = os.path.join(batch_dir, LEDGER_FILE)
+    with open(ledger_path, 'w') as f:
+        json.dump({'budget': batch['cores'], 'holders': {}, 'waiting': {}}, f)
+    env = dict(os.environ, **{LEDGER_ENV: ledger_path})
+
+    def run(entry):
+        if entry.get('completed'):
+            print(f"[INFO] {entry['run_id']} already completed in {entry['completed']}, skipped", flush=True)
+            return 0
+        state_args, state = utils.load_state(entry['run_id']) if os.path.isdir(utils.working_dir(entry['run_id'])) else (None, None)
+        if utils.run_completed(state):
+            print(f"[INFO] {entry['run_id']} already completed, skipped", flush=True)
+            return 0
+        cmd = [sys.executable, *run_command(entry, threads)]
+        print(f"[INFO] Starting {entry['run_id']} (estimated runtime={entry['predicted']:.2f} minutes)", flush=True)
+        with open(os.path.join(batch_dir, f"{entry['run_id']}.out"), 'a') as out:
+            returncode = subprocess.run(cmd, stdout=out, stderr=subprocess.STDOUT, env=env).returncode
+        print(f"[INFO] {entry['run_id']} finished with exit code {returncode}", flush=True)
+        if returncode == 0:
+            save_batch(batch, batch_dir, entry, completed=final_dir(entry))
+        return returncode
+
+    # Longest predicted runs first, so that the short ones fill the end of the batch
+    ordered = sorted(batch['runs'] if runs is None else runs, key=lambda entry: entry['predicted'], reverse=True)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        returncodes = list(pool.map(run, ordered))
+    return [entry['run_id'] for entry, code in zip(ordered, returncodes) if code != 0]
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Run several Brownaming analyses on one node under a global core budget")
+    parser.add_argument('manifest', help="Text file with one run per line: FASTA TAXID [main.py options]")
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 1, help='Cores shared by all the DIAMOND steps of the batch (default: all)')
+    parser.add_argument('--threads', type=int, default=None, help='DIAMOND threads of each step unless the manifest sets --threads (default: cores / 4)')
+    parser.add_argument('--jobs', type=int, default=None, help='Runs executed at the same time (default: twice the number of steps that fit in the core budget)')
+    parser.add_argument('--batch-id', help='Batch ID, also the prefix of the run IDs. Re-use it to resume a batch (default: timestamp)')
+    parser.add_argument('--local-db', help='Path to local database, used for the runtime predictions')
+    parser.add_argument('--share-steps', action='store_true', help='Search the taxonomic steps above the common ancestor of runs with the same options once for all of them')
+    args = parser.parse_args(argv)
+    if args.share_steps:
+        import shared_steps
+
+    threads = max(1, min(args.threads or args.cores // 4, args.cores))
+    # More runs than fit in the budget, so that waiting steps can fill freed cores
+    jobs = args.jobs or max(1, 2 * (args.cores // threads))
+    batch_id = args.batch_id or datetime.now().strftime('%Y-%m-%d-%H-%M')
+    batch_dir = os.path.join(utils.script_dir(), 'runs', f"{batch_id}-batch")
+    batch_path = os.path.join(batch_dir, BATCH_FILE)
+    os.makedirs(batch_dir, exist_ok=True)
+
+    if os.path.exists(batch_path):
+        with open(batch_path, 'r') as f:
+            batch = json.load(f)
+        batch['cores'] = args.cores
+        print(f"[INFO] Resuming the {len(batch['runs'])} runs of {batch_path}")
+    else:
+        runs = read_manifest(args.manifest)
+        if not runs:
+            print(f"[ERROR] No run found in {args.manifest}")
+            exit(1)
+        utils.LOCAL_DB_PATH = args.local_db or utils.set_local_db_path()
+        utils.PARENT = utils.set_parent_dict()
+        utils.TAXID_TO_DBSIZE = utils.set_taxid_to_dbsize()
+        for i, run in enumerate(runs, start=1):
+            if not os.path.isfile(run['fasta']):
+                print(f"[ERROR] File not found: {run['fasta']}")
+                exit(1)
+            run['run_id'] = f"{batch_id}-{i:03d}-{run['species']}"
+            if args.local_db and '--local-db' not in run['run_args']:
+                run['run_args'] += ['--local-db', args.local_db]
+        if args.share_steps and not utils.PARENT:
+            print("[ERROR] Taxonomy helpers not found, --share-steps needs them to align the lineages")
+            exit(1)
+        shared = shared_steps.plan(batch_id, batch_dir, runs) if args.share_steps else []
+        for run in runs:
+            run['predicted'] = predict_run(run) if utils.PARENT else 0.0
+        batch = {'manifest': os.path.abspath(args.manifest), 'cores': args.cores, 'runs': runs, 'shared': shared}
+    save_batch(batch, batch_dir)
+
+    print(f"[INFO] Batch {batch_id}: {len(batch['runs'])} runs, {args.cores} cores, {threads} threads per step, {jobs} concurrent runs")
+    if batch.get('shared'):
+        import shared_steps
+        failed = shared_steps.run(batch, batch_dir, jobs, threads)
+    else:
+        failed = run_batch(batch, batch_dir, jobs, threads)
+    if failed:
+        print(f"[ERROR] {len(failed)} runs failed ({', '.join(failed)}), see {batch_dir}/*.out. Re-run with --batch-id {batch_id} to resume them.")
+        exit(1)
+    print(f"[INFO] All {len(batch['runs'])} runs completed")
@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import utils, homology, excel, stats
+
+# Splits a large query FASTA into shards that run as independent Brownaming runs
+# (own run ID, state and resume), then merges their results into the usual
+# outputs. Shards only coordinate through files: the manifest written next to
+# the shard FASTA files and the runs/<run_id> directories.
+MANIFEST_FILE = "shards.json"
+COMMANDS_FILE = "commands.txt"
+FORBIDDEN_RUN_ARGS = ('-p', '--proteins', '-s', '--species', '--run-id', '--resume', '--working-dir')
+
+
+def shard_command(shard, species, run_args):
+    main_py = os.path.join(utils.script_dir(), 'main.py')
+    if os.path.exists(os.path.join(utils.working_dir(shard['run_id']), 'state_args.json')):
+        return [sys.executable, main_py, '--resume', shard['run_id']]
+    return [sys.executable, main_py, '-p', shard['fasta'], '-s', str(species), '--run-id', shard['run_id'], *run_args]
+
+def create_shards(query_fasta, species, n_shards, shard_dir, run_prefix, run_args):
+    os.makedirs(shard_dir, exist_ok=True)
+    index = utils.build_fasta_index(query_fasta)
+    if not index:
+        print(f"[ERROR] No sequence found in {query_fasta}")
+        exit(1)
+    basename = os.path.basename(query_fasta)
+    stem, ext = os.path.splitext(basename)
+    shards = []
+    for i, records in enumerate(utils.balance_records(index, n_shards), start=1):
+        shard_fasta = os.path.join(shard_dir, f"{stem}.shard{i:03d}{ext or '.fasta'}")
+        utils.copy_fasta_records(query_fasta, records, shard_fasta)
+        shards.append({
+            'fasta': shard_fasta,
+            'run_id': f"{run_prefix}-shard{i:03d}",
+            'sequences': len(records),
+            'residues': sum(entry[3] for entry in records)
+        })
+        print(f"[INFO] Shard {i}: {len(records)} sequences, {shards[-1]['residues']} residues -> {shard_fasta}")
+
+    manifest = {
+        'query_fasta': os.path.abspath(query_fasta),
+        'species': species,
+        'run_args': run_args,
+        'shards': shards
+    }
+    with open(os.path.join(shard_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    # One command per line, for job arrays of external schedulers. Each line goes
+    # through shard-run, so re-submitting it after a preemption resumes the shard
+    main_py = os.path.join(utils.script_dir(), 'main.py')
+    with open(os.path.join(shard_dir, COMMANDS_FILE), 'w') as f:
+        for i in range(1, len(shards) + 1):
+            f.write(shlex.join([sys.executable, main_py, 'shard-run', shard_dir, str(i)]) + "\n")
+    print(f"[INFO] Manifest written to {os.path.join(shard_dir, MANIFEST_FILE)}")
+    return manifest
+
+def run_shards(manifest, shard_dir, jobs):
+    run_args = list(manifest['run_args'])
+    if '--threads' not in run_args:
+        run_args += ['--threads', str(max(1, (os.cpu_count() or 1) // jobs))]
+
+    def run(shard):
+        cmd = shard_command(shard, manifest['species'], run_args)
+        print(f"[INFO] Starting {shard['run_id']}", flush=True)
+        with open(os.path.join(shard_dir, f"{shard['run_id']}.out"), 'a') as out:
+            returncode = subprocess.run(cmd, stdout=out, stderr=subprocess.STDOUT).returncode
+        print(f"[INFO] {shard['run_id']} finished with exit code {returncode}", flush=True)
+        return returncode
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        returncodes = list(pool.map(run, manifest['shards']))
+    return all(code == 0 for code in returncodes)
+
+def run_shard(manifest, number):
+    if not 1 <= number <= len(manifest['shards']):
+        print(f"[ERROR] Shard {number} not found, the manifest has {len(manifest['shards'])} shards")
+        exit(1)
+    shard = manifest['shards'][number - 1]
+    if os.path.isdir(utils.working_dir(shard['run_id'])):
+        _, state = utils.load_state(shard['run_id'])
+        if utils.run_completed(state):
+            print(f"[INFO] {shard['run_id']} already completed, skipped")
+            return
+    cmd = shard_command(shard, manifest['species'], manifest['run_args'])
+    exit(subprocess.run(cmd).returncode)
+
+def merge_stats(stats_list):
+    steps = sorted({key for stats_data in stats_list for key in stats_data}, key=lambda k: int(k.split()[1]))
+    merged = {}
+    last_hits = [0] * len(stats_list)
+    for key in steps:
+        step_stats = None
+        nb_query = 0
+        prots_with_hit = 0
+        elapsed = 0.0
+        for i, stats_data in enumerate(stats_list):
+            if key in stats_data:
+                data = stats_data[key]
+                step_stats = step_stats or dict(data)
+                nb_query += data['nb_query']
+                last_hits[i] = data.get('prots_with_hit', last_hits[i])
+                elapsed = max(elapsed, float(data['elapsed_time']))
+            # A shard that stopped earlier keeps the proteins it already named
+            prots_with_hit += last_hits[i]
+        step_stats['nb_query'] = nb_query
+        step_stats['prots_with_hit'] = prots_with_hit
+        step_stats['elapsed_time'] = f"{elapsed:.2f}"
+        merged[key] = step_stats
+    return merged
+
+def merge_shards(manifest, output_dir):
+    states = []
+    state_args = None
+    for shard in manifest['shards']:
+        state_args, state = utils.load_state(shard['run_id'])
+        if not utils.run_completed(state):
+            print(f"[ERROR] Shard run {shard['run_id']} is missing or not completed")
+            exit(1)
+        states.append(state)
+
+    utils.LOCAL_DB_PATH = state_args.get('local_db') or utils.set_local_db_path()
+    utils.TAXID_TO_NAME = utils.set_taxid_to_scientificname()
+
+    assigned = {}
+    for state in states:
+        assigned.update(homology.as_hits(state['assigned']))
+    stats_data = merge_stats([state['stats_data'] for state in states])
+
+    query_fasta = manifest['query_fasta']
+    query_ids = [entry[0] for entry in utils.build_fasta_index(query_fasta)]
+    os.makedirs(output_dir, exist_ok=True)
+    output_fasta_file, output_stats_file, output_excel_file = utils.output_files(query_fasta, output_dir)
+
+    stats.generate_combined_figure(stats_data, output_file=output_stats_file)
+    excel.write_results(query_ids, assigned, output_excel_file, table_format=state_args.get('table_format', 'xlsx'))
+    utils.write_brownamed_fasta(query_fasta, assigned, output_fasta_file, compress=state_args.get('compress_fasta', False))
+    print(f"[INFO] Merged {len(states)} shards ({len(query_ids)} sequences, {len(assigned)} named) into {output_dir}")
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="main.py", description="Brownaming query sharding")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    shard_parser = subparsers.add_parser('shard', help='Split the query FASTA into shards balanced by residue count', epilog='Other arguments are passed to every shard run (e.g. --threads, --last-tax, --swissprot-only).')
+    shard_parser.add_argument('-p', '--proteins', required=True, help='FASTA file of query proteins')
+    shard_parser.add_argument('-s', '--species', type=int, required=True, help='Taxonomy ID of the target species')
+    shard_parser.add_argument('-n', '--shards', type=int, required=True, help='Number of shards')
+    shard_parser.add_argument('-o', '--shard-dir', help='Directory for the shard FASTA files and manifest (default: runs/<run-prefix>-shards)')
+    shard_parser.add_argument('--run-prefix', help='Prefix of the shard run IDs (default: timestamp-taxid)')
+    shard_parser.add_argument('--jobs', type=int, default=0, help='Run the shards with a local pool of this many processes, then merge (default: 0, only prepare the shards)')
+
+    run_parser = subparsers.add_parser('shard-run', help='Run one shard, resuming it when its run already started')
+    run_parser.add_argument('manifest', help=f'Shard directory or its {MANIFEST_FILE}')
+    run_parser.add_argument('shard', type=int, help='Shard number (1 for the first line of commands.txt)')
+
+    merge_parser = subparsers.add_parser('merge', help='Merge completed shard runs into the usual outputs')
+    merge_parser.add_argument('manifest', help=f'Shard directory or its {MANIFEST_FILE}')
+    merge_parser.add_argument('-o', '--output-dir', help='Output directory (default: the shard directory)')
+
+    args, run_args = parser.parse_known_args(argv)
+
+    if args.command == 'shard':
+        for arg in run_args:
+            if arg.split('=')[0] in FORBIDDEN_RUN_ARGS:
+                parser.error(f"{arg} is set per shard and cannot be passed to the shard runs")
+        if not os.path.isfile(args.proteins):
+            print(f"[ERROR] File not found: {args.proteins}")
+            exit(1)
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+        excel.check_run_args(run_args)
+        run_prefix = args.run_prefix or f"{datetime.now().strftime('%Y-%m-%d-%H-%M')}-{args.species}"
+        shard_dir = os.path.abspath(args.shard_dir or os.path.join(utils.script_dir(), 'runs', f"{run_prefix}-shards"))
+        manifest_path = os.path.join(shard_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            # Same shard directory again: keep the existing shards so their runs resume
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            print(f"[INFO] Reusing the {len(manifest['shards'])} shards of {manifest_path}")
+        else:
+            manifest = create_shards(args.proteins, args.species, args.shards, shard_dir, run_prefix, run_args)
+        if args.jobs > 0:
+            if not run_shards(manifest, shard_dir, args.jobs):
+                print(f"[ERROR] Some shard runs failed, see {shard_dir}/*.out. Re-run with the same --run-prefix or --shard-dir to resume them.")
+                exit(1)
+            merge_shards(manifest, shard_dir)
+        else:
+            print(f"[INFO] Run the commands in {os.path.join(shard_dir, COMMANDS_FILE)}, then: python main.py merge {shard_dir}")
+    else:
+        if run_args:
+            parser.error(f"unrecognized arguments: {' '.join(run_args)}")
+        manifest_path = args.manifest
+        if os.path.isdir(manifest_path):
+            manifest_path = os.path.join(manifest_path, MANIFEST_FILE)
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if args.command == 'shard-run':
+            run_shard(manifest, args.shard)
+        else:
+            merge_shards(manifest, os.path.abspath(args.output_dir or os.path.dirname(os.path.abspath(manifest_path))))
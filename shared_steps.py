@@ -0,0 +1,192 @@
+import os
+import shutil
+import utils, homology, excel, stats, scheduler
+
+# Shared taxonomic steps for batches of related species (main.py batch
+# --share-steps). Above the lowest common ancestor (LCA) of the species, every
+# run would search the same taxon list, so each run first stops at the LCA
+# (--last-tax), then one run searches the pending proteins of all the species
+# from the parent of the LCA upward, with --ex-tax LCA standing in for the
+# previous step. Query IDs of that run are prefixed with the index of their
+# run ("003|ID"), and its hits are split back into the runs at the end.
+NAMESPACE_SEP = "|"
+
+
+def pop_option(run_args, name):
+    value = None
+    remaining = []
+    i = 0
+    while i < len(run_args):
+        arg = run_args[i]
+        if arg == name and i + 1 < len(run_args):
+            value = run_args[i + 1]
+            i += 2
+            continue
+        if arg.startswith(name + "="):
+            value = arg.split("=", 1)[1]
+        else:
+            remaining.append(arg)
+        i += 1
+    return value, remaining
+
+def lowest_common_ancestor(taxids):
+    lineages = [utils.get_lineage(taxid) for taxid in taxids]
+    common = set(lineages[0]).intersection(*lineages[1:])
+    for taxid in lineages[0]:
+        if taxid in common:
+            return taxid
+    return None
+
+def plan(batch_id, batch_dir, runs):
+    # Runs sharing the same search options are grouped; the others keep running alone
+    groups = {}
+    for i, run in enumerate(runs):
+        working_dir, run_args = pop_option(run['run_args'], '--working-dir')
+        last_tax, run_args = pop_option(run_args, '--last-tax')
+        _, key_args = pop_option(run_args, '--threads')
+        run['working_dir'] = os.path.abspath(working_dir) if working_dir else None
+        run['last_tax'] = int(last_tax) if last_tax else None
+        run['run_args'] = run_args
+        run['namespace'] = f"{i + 1:03d}"
+        groups.setdefault((tuple(key_args), run['last_tax']), []).append(run)
+
+    shared = []
+    for (key_args, last_tax), members in groups.items():
+        lca = lowest_common_ancestor([run['species'] for run in members]) if len(members) > 1 else None
+        lineage = utils.get_lineage(members[0]['species'], last_tax)
+        if lca is None or lca not in lineage or lca == lineage[-1]:
+            # No step above the LCA to share
+            for run in members:
+                if run['last_tax']:
+                    run['run_args'] += ['--last-tax', str(run['last_tax'])]
+                if run['working_dir']:
+                    run['run_args'] += ['--working-dir', run['working_dir']]
+            continue
+        upper = utils.PARENT.get(str(lca))
+        for run in members:
+            run['run_args'] += ['--last-tax', str(lca)]
+        run_id = f"{batch_id}-shared-{lca}"
+        shared_args = list(key_args) + ['--ex-tax', str(lca)]
+        if last_tax:
+            shared_args += ['--last-tax', str(last_tax)]
+        shared.append({
+            'run_id': run_id,
+            'lca': lca,
+            'species': upper,
+            'fasta': os.path.join(batch_dir, f"{run_id}.fasta"),
+            'run_args': shared_args,
+            'members': [run['run_id'] for run in members],
+            'predicted': 0.0
+        })
+        print(f"[INFO] {len(members)} runs share the steps above taxon {lca}, searched once by {run_id}")
+    return shared
+
+def write_shared_fasta(runs, shared_run):
+    # Pending proteins of every member run, with namespaced IDs
+    building = shared_run['fasta'] + '.building'
+    count = 0
+    with open(building, 'wb') as out_f:
+        for run in runs:
+            _, state = utils.load_state(run['run_id'])
+            pending = state['pending']
+            prefix = (run['namespace'] + NAMESPACE_SEP).encode()
+            with open(run['fasta'], 'rb') as in_f:
+                for entry in utils.build_fasta_index(run['fasta']):
+                    if entry[0] not in pending:
+                        continue
+                    in_f.seek(entry[1])
+                    record = in_f.read(entry[2])
+                    if not record.endswith(b"\n"):
+                        record += b"\n"
+                    out_f.write(b">" + prefix + record[1:])
+                    count += 1
+    os.replace(building, shared_run['fasta'])
+    return count
+
+def merge_stats(run_stats, shared_records, pending, prefix, run_assigned):
+    # Steps of the shared run follow the run's own steps, counted from the
+    # shared run's journal for the proteins of this run only
+    merged = dict(run_stats)
+    last = run_stats[f"Step {len(run_stats)}"] if run_stats else {}
+    prots_with_hit = last.get('prots_with_hit', 0)
+    base_elapsed = float(last.get('elapsed_time', 0.0))
+    nb_query = len(pending)
+    named = set()
+    for record in shared_records:
+        data = dict(record['stats'])
+        data['nb_query'] = nb_query
+        for qseqid in record['assigned']:
+            q = qseqid[len(prefix):]
+            if qseqid.startswith(prefix) and q not in run_assigned and q not in named:
+                named.add(q)
+                prots_with_hit += 1
+        data['prots_with_hit'] = prots_with_hit
+        nb_query -= sum(1 for qseqid in record['resolved'] if qseqid.startswith(prefix))
+        data['elapsed_time'] = f"{base_elapsed + float(data['elapsed_time']):.2f}"
+        merged[f"Step {len(run_stats) + record['step']}"] = data
+    return merged
+
+def merge_run(run, shared_assigned, shared_records):
+    if run.get('merged'):
+        print(f"[INFO] {run['run_id']} already merged in {run['completed']}, skipped")
+        return
+    run_dir = utils.working_dir(run['run_id'])
+    if not os.path.isdir(run_dir):
+        # Moved to its --working-dir by a batch started before runs were marked merged
+        return
+    state_args, state = utils.load_state(run['run_id'])
+    assigned = homology.as_hits(state['assigned'])
+    prefix = run['namespace'] + NAMESPACE_SEP
+    stats_data = merge_stats(state['stats_data'], shared_records, state['pending'], prefix, assigned)
+    named = 0
+    for qseqid, hits in shared_assigned.items():
+        if qseqid.startswith(prefix):
+            q = qseqid[len(prefix):]
+            assigned[q] = [h.for_query(q) for h in hits]
+            named += 1
+
+    # Taxon names of the FASTA headers and tables, as in sharding.merge_shards
+    utils.LOCAL_DB_PATH = state_args.get('local_db') or utils.set_local_db_path()
+    utils.TAXID_TO_NAME = utils.set_taxid_to_scientificname()
+    output_fasta_file, output_stats_file, output_excel_file = utils.output_files(run['fasta'], run_dir)
+    stats.generate_combined_figure(stats_data, output_file=output_stats_file)
+    excel.write_results(state['query_ids'], assigned, output_excel_file, table_format=state_args.get('table_format', 'xlsx'))
+    utils.write_brownamed_fasta(run['fasta'], assigned, output_fasta_file, compress=state_args.get('compress_fasta', False))
+    if run['working_dir'] and os.path.abspath(run_dir) != run['working_dir']:
+        if os.path.exists(run['working_dir']):
+            print(f"[ERROR] Cannot move {run['run_id']} to '{run['working_dir']}' because destination already exists.")
+            return
+        os.makedirs(os.path.dirname(run['working_dir']), exist_ok=True)
+        shutil.move(run_dir, run['working_dir'])
+        run['completed'] = run['working_dir']
+    run['merged'] = True
+    print(f"[INFO] {run['run_id']}: {named} proteins named by the shared steps")
+
+def run(batch, batch_dir, jobs, threads):
+    failed = scheduler.run_batch(batch, batch_dir, jobs, threads)
+    if failed:
+        return failed
+
+    runs = {run['run_id']: run for run in batch['runs']}
+    ready = []
+    for shared_run in batch['shared']:
+        if not os.path.exists(shared_run['fasta']):
+            count = write_shared_fasta([runs[run_id] for run_id in shared_run['members']], shared_run)
+            print(f"[INFO] {shared_run['run_id']}: {count} pending proteins of {len(shared_run['members'])} runs")
+        if os.path.getsize(shared_run['fasta']):
+            ready.append(shared_run)
+    failed = scheduler.run_batch(batch, batch_dir, jobs, threads, runs=ready)
+    if failed:
+        return failed
+
+    for shared_run in batch['shared']:
+        shared_assigned, shared_records = {}, []
+        if shared_run in ready:
+            _, state = utils.load_state(shared_run['run_id'])
+            shared_assigned = homology.as_hits(state['assigned'])
+            records = utils.read_journal(utils.journal_path(shared_run['run_id']))
+            shared_records = [record for record in records if record['type'] == 'step']
+        for run_id in shared_run['members']:
+            merge_run(runs[run_id], shared_assigned, shared_records)
+            scheduler.save_batch(batch, batch_dir)
+    return []
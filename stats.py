@@ -1,9 +1,8 @@
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
 import os
 import re
 
 def generate_combined_figure(stats, output_file='combined_results.png'):
+    import matplotlib.pyplot as plt
     total_nb_query = stats['Step 1']['nb_query']
     stats_dict = {
         'step': ['0'],
@@ -110,6 +109,7 @@ def create_table(stats_dict, ax):
 
 
 def create_plot(stats_dict, ax):
+    from matplotlib.ticker import FuncFormatter
     color = 'tab:green'
     ax.plot(stats_dict['step'], stats_dict['%_prots_with_hit'], 'o-', color=color, label='Named proteins (%)')
     ax.set_ylabel('Named proteins (%)', color=color)
@@ -0,0 +1,229 @@
+import json
+import os
+from collections.abc import Mapping
+import numpy as np
+
+# Binary taxonomy store written by create_taxonomy_json.py. Every array is indexed
+# by taxid and opened memory-mapped, so concurrent runs share the same pages
+# through the OS page cache. The views below expose them with the same interface
+# as the JSON dicts (string keys) they replace.
+PARENT_FILE = "parent.npy"
+RANK_FILE = "rank.npy"
+RANK_NAMES_FILE = "rank_names.json"
+CHILDREN_INDPTR_FILE = "children_indptr.npy"
+CHILDREN_INDICES_FILE = "children_indices.npy"
+NAMES_FILE = "names.bin"
+NAMES_OFFSETS_FILE = "names_offsets.npy"
+DBSIZE_TOTAL_FILE = "dbsize_total.npy"
+DBSIZE_SWISSPROT_FILE = "dbsize_swissprot.npy"
+
+NO_PARENT = -1
+NO_RANK = 255
+
+
+def _taxid(key):
+    try:
+        return int(key)
+    except (TypeError, ValueError):
+        raise KeyError(key)
+
+
+class _ArrayView(Mapping):
+    def __init__(self, size):
+        self._size = size
+        self._keys = None
+
+    def _present(self):
+        raise NotImplementedError
+
+    def _value(self, taxid):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        taxid = _taxid(key)
+        if taxid < 0 or taxid >= self._size:
+            raise KeyError(key)
+        return self._value(taxid)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        if self._keys is None:
+            self._keys = np.flatnonzero(self._present())
+        return (str(taxid) for taxid in self._keys)
+
+    def __len__(self):
+        if self._keys is None:
+            self._keys = np.flatnonzero(self._present())
+        return len(self._keys)
+
+
+class ParentView(_ArrayView):
+    def __init__(self, parent):
+        super().__init__(len(parent))
+        self.array = parent
+
+    def _present(self):
+        return self.array != NO_PARENT
+
+    def _value(self, taxid):
+        par = int(self.array[taxid])
+        if par == NO_PARENT:
+            raise KeyError(str(taxid))
+        return par
+
+
+class RankView(_ArrayView):
+    def __init__(self, ranks, rank_names):
+        super().__init__(len(ranks))
+        self.array = ranks
+        self.rank_names = rank_names
+
+    def _present(self):
+        return self.array != NO_RANK
+
+    def _value(self, taxid):
+        code = int(self.array[taxid])
+        if code == NO_RANK:
+            raise KeyError(str(taxid))
+        return self.rank_names[code]
+
+
+class ChildrenView(_ArrayView):
+    def __init__(self, indptr, indices):
+        super().__init__(len(indptr) - 1)
+        self.indptr = indptr
+        self.indices = indices
+
+    def _present(self):
+        return np.diff(self.indptr) > 0
+
+    def _value(self, taxid):
+        start, end = int(self.indptr[taxid]), int(self.indptr[taxid + 1])
+        if start == end:
+            raise KeyError(str(taxid))
+        return self.indices[start:end].tolist()
+
+
+class NameView(_ArrayView):
+    def __init__(self, blob, offsets):
+        super().__init__(len(offsets) - 1)
+        self.blob = blob
+        self.offsets = offsets
+
+    def _present(self):
+        return np.diff(self.offsets) > 0
+
+    def _value(self, taxid):
+        start, end = int(self.offsets[taxid]), int(self.offsets[taxid + 1])
+        if start == end:
+            raise KeyError(str(taxid))
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+
+class DbsizeView(_ArrayView):
+    def __init__(self, total, swissprot):
+        super().__init__(len(total))
+        self.total = total
+        self.swissprot = swissprot
+
+    def _present(self):
+        return self.total > 0
+
+    def _value(self, taxid):
+        total = int(self.total[taxid])
+        if total == 0:
+            raise KeyError(str(taxid))
+        return {"swissprot": int(self.swissprot[taxid]), "total": total}
+
+
+def has_store(taxonomy_dir, *files):
+    return all(os.path.exists(os.path.join(taxonomy_dir, name)) for name in files)
+
+def _load(taxonomy_dir, name):
+    return np.load(os.path.join(taxonomy_dir, name), mmap_mode='r')
+
+def open_parent(taxonomy_dir):
+    if has_store(taxonomy_dir, PARENT_FILE):
+        return ParentView(_load(taxonomy_dir, PARENT_FILE))
+
+def open_rank(taxonomy_dir):
+    if has_store(taxonomy_dir, RANK_FILE, RANK_NAMES_FILE):
+        with open(os.path.join(taxonomy_dir, RANK_NAMES_FILE), 'r') as f:
+            rank_names = json.load(f)
+        return RankView(_load(taxonomy_dir, RANK_FILE), rank_names)
+
+def open_children(taxonomy_dir):
+    if has_store(taxonomy_dir, CHILDREN_INDPTR_FILE, CHILDREN_INDICES_FILE):
+        return ChildrenView(_load(taxonomy_dir, CHILDREN_INDPTR_FILE), _load(taxonomy_dir, CHILDREN_INDICES_FILE))
+
+def open_names(taxonomy_dir):
+    if has_store(taxonomy_dir, NAMES_FILE, NAMES_OFFSETS_FILE):
+        offsets = _load(taxonomy_dir, NAMES_OFFSETS_FILE)
+        blob_path = os.path.join(taxonomy_dir, NAMES_FILE)
+        # np.memmap refuses empty files
+        blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if os.path.getsize(blob_path) else np.zeros(0, dtype=np.uint8)
+        return NameView(blob, offsets)
+
+def open_dbsize(taxonomy_dir):
+    if has_store(taxonomy_dir, DBSIZE_TOTAL_FILE, DBSIZE_SWISSPROT_FILE):
+        return DbsizeView(_load(taxonomy_dir, DBSIZE_TOTAL_FILE), _load(taxonomy_dir, DBSIZE_SWISSPROT_FILE))
+
+
+def write_store(taxonomy_dir, parent, rank, children, taxid_to_name, total_count, swissprot_count):
+    max_taxid = max(max(parent, default=0), max(taxid_to_name, default=0), max(total_count, default=0))
+    size = max_taxid + 1
+
+    parent_arr = np.full(size, NO_PARENT, dtype=np.int32)
+    for taxid, par in parent.items():
+        parent_arr[taxid] = par
+    np.save(os.path.join(taxonomy_dir, PARENT_FILE), parent_arr)
+
+    rank_names = sorted(set(rank.values()))
+    if len(rank_names) >= NO_RANK:
+        raise ValueError(f"Too many distinct ranks ({len(rank_names)}) for uint8 rank codes")
+    rank_code = {r: code for code, r in enumerate(rank_names)}
+    rank_arr = np.full(size, NO_RANK, dtype=np.uint8)
+    for taxid, r in rank.items():
+        rank_arr[taxid] = rank_code[r]
+    np.save(os.path.join(taxonomy_dir, RANK_FILE), rank_arr)
+    with open(os.path.join(taxonomy_dir, RANK_NAMES_FILE), 'w') as f:
+        json.dump(rank_names, f)
+
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    for par, kids in children.items():
+        indptr[par + 1] = len(kids)
+    np.cumsum(indptr, out=indptr)
+    indices = np.empty(int(indptr[-1]), dtype=np.int32)
+    for par, kids in children.items():
+        indices[indptr[par]:indptr[par + 1]] = sorted(kids)
+    np.save(os.path.join(taxonomy_dir, CHILDREN_INDPTR_FILE), indptr)
+    np.save(os.path.join(taxonomy_dir, CHILDREN_INDICES_FILE), indices)
+
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    with open(os.path.join(taxonomy_dir, NAMES_FILE), 'wb') as f:
+        position = 0
+        for taxid in range(size):
+            name = taxid_to_name.get(taxid)
+            if name:
+                encoded = name.encode("utf-8")
+                f.write(encoded)
+                position += len(encoded)
+            offsets[taxid + 1] = position
+    np.save(os.path.join(taxonomy_dir, NAMES_OFFSETS_FILE), offsets)
+
+    total_arr = np.zeros(size, dtype=np.int64)
+    swissprot_arr = np.zeros(size, dtype=np.int64)
+    for taxid, count in total_count.items():
+        if 0 <= taxid < size:
+            total_arr[taxid] = count
+    for taxid, count in swissprot_count.items():
+        if 0 <= taxid < size:
+            swissprot_arr[taxid] = count
+    np.save(os.path.join(taxonomy_dir, DBSIZE_TOTAL_FILE), total_arr)
+    np.save(os.path.join(taxonomy_dir, DBSIZE_SWISSPROT_FILE), swissprot_arr)
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import homology
+import utils
+
+# run_diamond against a fake diamond that writes a few hits, then keeps running
+# for FAKE_DIAMOND_SLEEP seconds.
+
+FAKE_DIAMOND = """#!{python}
+import os, time
+for i in range(3):
+    print(f"q1\\tsp|S{{i}}|S{{i}}_X\\t90.0\\t80.0\\t150\\t1e-50\\t{{200 - i}}.0\\t150\\t150\\t40\\tS{{i}} Protein OS=X OX=40", flush=True)
+time.sleep(float(os.environ.get("FAKE_DIAMOND_SLEEP", 0)))
+"""
+
+
+@pytest.fixture
+def fake_diamond(tmp_path, monkeypatch):
+    script = tmp_path / "diamond"
+    script.write_text(FAKE_DIAMOND.format(python=sys.executable))
+    script.chmod(0o755)
+    monkeypatch.setattr(homology, "which_or_die", lambda name: str(script))
+    monkeypatch.setattr(utils, "working_dir", lambda run_id: str(tmp_path))
+    monkeypatch.setattr(utils, "select_db", lambda swissprot_only, taxonlist=None: ("db.dmnd", None))
+    return tmp_path
+
+def run(metrics):
+    return homology.run_diamond("run", "query.fasta", [40], (30, "taxon 30", "genus"), threads=1, metrics=metrics)
+
+
+def test_not_started_until_consumed(fake_diamond):
+    metrics = {}
+    hits = run(metrics)
+    assert not (fake_diamond / "diamond.log").exists()
+    assert metrics == {}
+    hits.close()
+    assert not (fake_diamond / "diamond.log").exists()
+
+def test_fully_consumed(fake_diamond):
+    metrics = {}
+    hits = list(run(metrics))
+    assert [h.sseqid for h in hits] == ["sp|S0|S0_X", "sp|S1|S1_X", "sp|S2|S2_X"]
+    assert metrics['diamond_runs'] == 1 and metrics['hits'] == 3
+
+def test_closed_early_kills_diamond(fake_diamond, monkeypatch):
+    monkeypatch.setenv("FAKE_DIAMOND_SLEEP", "60")
+    metrics = {}
+    hits = run(metrics)
+    assert next(hits).sseqid == "sp|S0|S0_X"
+    start = time.perf_counter()
+    hits.close()
+    assert time.perf_counter() - start < 10
+    # Reaped in the finally block: resource usage recorded
+    assert metrics['hits'] == 1 and 'diamond_wall' in metrics
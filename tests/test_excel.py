@@ -0,0 +1,74 @@
+import csv
+import importlib.util
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import excel
+import homology
+import utils
+
+
+def hit(qseqid, sseqid, bits):
+    return homology.Hit(
+        qseqid, sseqid, 90.0, 95.0, 150, 1e-50, bits, 150, 150, 9606, f"{sseqid} Kinase OS=Homo sapiens OX=9606 GN=KIN1",
+        homology.ancestor(9604, "Hominidae", "family"), 1.0, 0.5
+    )
+
+@pytest.fixture(autouse=True)
+def names(monkeypatch):
+    monkeypatch.setattr(utils, "TAXID_TO_NAME", {"9606": "Homo sapiens"})
+
+def numbered_table(n):
+    table = excel.Table("Sheet")
+    for i in range(n):
+        table.append(excel.no_hit_row(f"q{i}"))
+    return table
+
+
+def test_write_tables_splits_long_tables(tmp_path, monkeypatch):
+    openpyxl = pytest.importorskip("openpyxl")
+    # Header and 3 rows per sheet
+    monkeypatch.setattr(excel, "MAX_SHEET_ROWS", 4)
+    path = tmp_path / "results.xlsx"
+    excel.write_tables([numbered_table(7), excel.Table("Top3 hits")], path)
+    wb = openpyxl.load_workbook(path, read_only=True)
+    assert wb.sheetnames == ["Sheet", "Sheet (2)", "Sheet (3)", "Top3 hits"]
+    sheets = [[row[0] for row in wb[name].iter_rows(values_only=True)] for name in wb.sheetnames]
+    assert sheets == [
+        ["Query accession", "q0", "q1", "q2"],
+        ["Query accession", "q3", "q4", "q5"],
+        ["Query accession", "q6"],
+        # An empty table still gets its header
+        ["Query accession"],
+    ]
+
+def test_write_tables_exact_sheet_size(tmp_path, monkeypatch):
+    openpyxl = pytest.importorskip("openpyxl")
+    monkeypatch.setattr(excel, "MAX_SHEET_ROWS", 4)
+    path = tmp_path / "results.xlsx"
+    excel.write_tables([numbered_table(6)], path)
+    assert openpyxl.load_workbook(path, read_only=True).sheetnames == ["Sheet", "Sheet (2)"]
+
+def test_write_results_tsv(tmp_path):
+    assigned = {"q1": [hit("q1", "sp|P1|P1_HUMAN", 250.0), hit("q1", "sp|P2|P2_HUMAN", 120.0)]}
+    paths = excel.write_results(["q1", "q2"], assigned, str(tmp_path / "query_diamond_results.xlsx"), table_format="tsv")
+    assert paths == [str(tmp_path / "query_diamond_results.tsv"), str(tmp_path / "query_diamond_results_top3.tsv")]
+    tables = []
+    for path in paths:
+        with open(path, newline='') as f:
+            tables.append(list(csv.reader(f, delimiter='\t')))
+    best, top3 = tables
+    assert best[0] == excel.HEADERS and top3[0] == excel.HEADERS
+    assert [row[:2] for row in best[1:]] == [["q1", "sp|P1|P1_HUMAN"], ["q2", ""]]
+    assert [row[:2] for row in top3[1:]] == [["q1", "sp|P1|P1_HUMAN"], ["q1", "sp|P2|P2_HUMAN"], ["q2", ""]]
+    assert best[1][3:7] == ["9606", "Homo sapiens", "KIN1", "250.0"]
+    assert best[1][10:] == ["100.00", "50.00", "family", "9604", "Hominidae", "True"]
+    assert best[2][-1] == "False"
+
+@pytest.mark.skipif(importlib.util.find_spec("pyarrow") is not None, reason="pyarrow is installed")
+def test_parquet_without_pyarrow_fails_early():
+    with pytest.raises(SystemExit):
+        excel.check_table_format("parquet")
+    with pytest.raises(SystemExit):
+        excel.check_run_args(["--threads", "4", "--table-format", "parquet"])
@@ -0,0 +1,70 @@
+import gzip
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import homology
+import utils
+
+QUERY = (
+    b">q1 original description\n"
+    b"MKVLAAGIVG\n"
+    b"lltgsAAQA\n"
+    b">q2\n"
+    b"MSTNPKPQRK\n"
+    b">q3 no hit OS=Nothing\n"
+    b"MA\n"
+)
+
+
+def hit(qseqid, staxid, title):
+    return homology.Hit(
+        qseqid, "sp|P1|P1_X", 90.0, 95.0, 150, 1e-50, 250.0, 150, 150, staxid, title,
+        homology.ancestor(20, "taxon 20", "family")
+    )
+
+@pytest.fixture
+def query(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "TAXID_TO_NAME", {"9606": "Homo sapiens"})
+    path = tmp_path / "query.fasta"
+    path.write_bytes(QUERY)
+    return path
+
+ASSIGNED = {
+    "q1": [hit("q1", 9606, "P1 Serine/threonine kinase 2 OS=Homo sapiens OX=9606 GN=STK2 PE=1 SV=2")],
+    # Taxon without a known name
+    "q2": [hit("q2", 123, "P2 Ribosomal protein L3 OS=Unknown OX=123")],
+}
+EXPECTED = (
+    b">q1 Serine/threonine kinase 2 FROM Homo sapiens\n"
+    b"MKVLAAGIVG\n"
+    b"lltgsAAQA\n"
+    b">q2 Ribosomal protein L3 FROM \n"
+    b"MSTNPKPQRK\n"
+    b">q3 Uncharacterized protein\n"
+    b"MA\n"
+)
+
+
+def test_headers_rewritten_sequences_copied(query, tmp_path):
+    output = str(tmp_path / "query_brownamed.fasta")
+    assert utils.write_brownamed_fasta(str(query), ASSIGNED, output) == output
+    with open(output, 'rb') as f:
+        assert f.read() == EXPECTED
+    assert not os.path.exists(output + '.building')
+
+def test_compress_fasta(query, tmp_path):
+    output = str(tmp_path / "query_brownamed.fasta")
+    assert utils.write_brownamed_fasta(str(query), ASSIGNED, output, compress=True) == output + '.gz'
+    with gzip.open(output + '.gz', 'rb') as f:
+        assert f.read() == EXPECTED
+    assert not os.path.exists(output)
+
+def test_last_record_without_newline(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "TAXID_TO_NAME", {})
+    path = tmp_path / "query.faa"
+    path.write_bytes(b">q1\nMKV")
+    output = str(tmp_path / "query_brownamed.fasta")
+    utils.write_brownamed_fasta(str(path), {}, output)
+    with open(output, 'rb') as f:
+        assert f.read() == b">q1 Uncharacterized protein\nMKV"
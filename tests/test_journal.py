@@ -0,0 +1,101 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import utils
+
+
+def header():
+    return utils.journal_header("query.fasta", 40, ["q1", "q2", "q3", "q4"], [2.0, 3.0, 4.0], [10, 20, 30], 40)
+
+def write_journal(path, compress=False):
+    utils.start_journal(path, header(), compress)
+    utils.append_journal(path, utils.journal_step(1, {"q1": ["hit"]}, {"q1"}, 30, 40, {'nb_query': 4}, 60.0), compress)
+    utils.append_journal(path, utils.journal_chunk(2, "more-sensitive", {"q2"}, {"q2": ["hit"]}), compress)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip(tmp_path, compress):
+    path = str(tmp_path / utils.JOURNAL_FILE)
+    write_journal(path, compress)
+    assert [record['type'] for record in utils.read_journal(path)] == ['header', 'step', 'chunk']
+
+@pytest.mark.parametrize("cut", [1, utils.JOURNAL_FRAME.size, utils.JOURNAL_FRAME.size + 5])
+def test_torn_last_frame_is_dropped_and_repaired(tmp_path, cut):
+    path = str(tmp_path / utils.JOURNAL_FILE)
+    write_journal(path)
+    complete = os.path.getsize(path)
+    utils.append_journal(path, utils.journal_step(2, {}, set(), 20, 30, {}, 120.0))
+    # Interrupted while writing the last frame
+    with open(path, 'r+b') as f:
+        f.truncate(complete + cut)
+
+    assert len(utils.read_journal(path)) == 3
+    assert os.path.getsize(path) == complete + cut
+    assert len(utils.read_journal(path, repair=True)) == 3
+    assert os.path.getsize(path) == complete
+    # Frames appended after the repair are read back
+    utils.append_journal(path, utils.journal_step(2, {}, set(), 20, 30, {}, 120.0))
+    assert [record['type'] for record in utils.read_journal(path)] == ['header', 'step', 'chunk', 'step']
+
+def test_corrupted_last_frame_is_dropped(tmp_path):
+    path = str(tmp_path / utils.JOURNAL_FILE)
+    write_journal(path)
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    assert [record['type'] for record in utils.read_journal(path)] == ['header', 'step']
+
+def test_start_journal_replaces_a_previous_run(tmp_path):
+    path = str(tmp_path / utils.JOURNAL_FILE)
+    write_journal(path)
+    utils.start_journal(path, header())
+    assert [record['type'] for record in utils.read_journal(path)] == ['header']
+
+
+def test_replay_steps():
+    state = utils.replay_journal([
+        header(),
+        utils.journal_step(1, {"q1": ["hit"]}, {"q1"}, 30, 40, {'nb_query': 4}, 60.0),
+        utils.journal_step(2, {"q2": ["a", "b", "c"]}, set(), 20, 30, {'nb_query': 3}, 150.0),
+    ])
+    assert state['step'] == 2 and state['curr_tax'] == 20 and state['prev_group'] == 30
+    assert state['assigned'] == {"q1": ["hit"], "q2": ["a", "b", "c"]}
+    assert state['pending'] == {"q2", "q3", "q4"}
+    assert list(state['stats_data']) == ["Step 1", "Step 2"]
+    assert state['elapsed'] == 150.0
+    assert state['partial_step'] == {}
+
+def test_replay_chunks_of_the_interrupted_step():
+    state = utils.replay_journal([
+        header(),
+        # Chunks of step 1, then step 1 completed: no longer partial
+        utils.journal_chunk(1, "more-sensitive", {"q1"}, {"q1": ["hit"]}),
+        utils.journal_step(1, {"q1": ["hit"]}, {"q1"}, 30, 40, {}, 60.0),
+        # Step 2 interrupted after two chunks of its fast tier and one sensitive chunk
+        utils.journal_chunk(2, "fast", {"q2"}, {"q2": ["f2"]}),
+        utils.journal_chunk(2, "fast", {"q3", "q4"}, {"q4": ["f4"]}),
+        utils.journal_chunk(2, "more-sensitive", {"q3"}, {}),
+        # Not the step being resumed: ignored
+        utils.journal_chunk(3, "fast", {"q2"}, {"q2": ["x"]}),
+    ])
+    assert state['step'] == 1
+    assert state['partial_step'] == {
+        "fast": {'ids': {"q2", "q3", "q4"}, 'best': {"q2": ["f2"], "q4": ["f4"]}},
+        "more-sensitive": {'ids': {"q3"}, 'best': {}},
+    }
+
+def test_load_state_repairs_the_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "working_dir", lambda run_id: str(tmp_path))
+    (tmp_path / "state_args.json").write_text("{\"species\": 40}")
+    path = utils.journal_path("run")
+    write_journal(path)
+    complete = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(b"\x00\x01")
+    state_args, state = utils.load_state("run", repair=True)
+    assert state_args == {"species": 40}
+    assert state['step'] == 1 and state['partial_step']["more-sensitive"]['ids'] == {"q2"}
+    assert os.path.getsize(path) == complete
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import scheduler
+import utils
+
+
+def test_completed_run_moved_to_working_dir_is_skipped(tmp_path, monkeypatch):
+    # main.py moves the run to its --working-dir: runs/<run_id> no longer exists
+    calls = []
+    def fake_run(cmd, **kwargs):
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0)
+    monkeypatch.setattr(scheduler.subprocess, "run", fake_run)
+    monkeypatch.setattr(utils, "working_dir", lambda run_id: str(tmp_path / "runs" / run_id))
+    moved = tmp_path / "out" / "a"
+    batch = {'cores': 4, 'runs': [
+        {'run_id': 'b-001-40', 'fasta': 'a.fasta', 'species': 40, 'run_args': ['--working-dir', str(moved)], 'predicted': 1.0},
+        {'run_id': 'b-002-41', 'fasta': 'b.fasta', 'species': 41, 'run_args': [], 'predicted': 2.0},
+    ]}
+
+    assert scheduler.run_batch(batch, str(tmp_path), 2, 1) == []
+    assert len(calls) == 2
+    with open(tmp_path / scheduler.BATCH_FILE) as f:
+        saved = json.load(f)
+    assert [run['completed'] for run in saved['runs']] == [str(moved), str(tmp_path / "runs" / "b-002-41")]
+
+    assert scheduler.run_batch(saved, str(tmp_path), 2, 1) == []
+    assert len(calls) == 2
+
+def test_failed_run_is_not_recorded(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler.subprocess, "run", lambda cmd, **kwargs: subprocess.CompletedProcess(cmd, 1))
+    monkeypatch.setattr(utils, "working_dir", lambda run_id: str(tmp_path / "runs" / run_id))
+    batch = {'cores': 4, 'runs': [{'run_id': 'b-001-40', 'fasta': 'a.fasta', 'species': 40, 'run_args': [], 'predicted': 1.0}]}
+    assert scheduler.run_batch(batch, str(tmp_path), 1, 1) == ['b-001-40']
+    assert 'completed' not in batch['runs'][0]
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import excel
+import homology
+import shared_steps
+import stats
+import utils
+
+
+def hit(qseqid, staxid, title):
+    return homology.Hit(
+        qseqid, "sp|P1|P1_X", 90.0, 95.0, 150, 1e-50, 250.0, 150, 150, staxid, title,
+        homology.ancestor(20, "taxon 20", "family")
+    )
+
+def test_merged_run_headers_name_the_species(tmp_path, monkeypatch):
+    local_db = tmp_path / "db"
+    (local_db / "taxonomy").mkdir(parents=True)
+    with open(local_db / "taxonomy" / "taxid2scientific_name.json", "w") as f:
+        json.dump({"9606": "Homo sapiens", "10090": "Mus musculus"}, f)
+    fasta = tmp_path / "query.fasta"
+    fasta.write_text(">q1 first\nMKV\n>q2 second\nMLL\n")
+    run_dir = tmp_path / "runs" / "b-001-40"
+    run_dir.mkdir(parents=True)
+    state_args = {'local_db': str(local_db), 'table_format': 'tsv'}
+    state = {
+        'assigned': {'q1': [hit('q1', 10090, "P1 Kinase A OS=Mus musculus OX=10090")]},
+        'pending': {'q2'},
+        'stats_data': {},
+        'query_ids': ['q1', 'q2'],
+    }
+    # Names are loaded by the merge itself, as in a fresh batch process
+    monkeypatch.setattr(utils, "LOCAL_DB_PATH", None)
+    monkeypatch.setattr(utils, "TAXID_TO_NAME", {})
+    monkeypatch.setattr(utils, "working_dir", lambda run_id: str(tmp_path / "runs" / run_id))
+    monkeypatch.setattr(utils, "load_state", lambda run_id: (state_args, state))
+    monkeypatch.setattr(stats, "generate_combined_figure", lambda stats_data, output_file: None)
+    run = {'run_id': 'b-001-40', 'fasta': str(fasta), 'namespace': '001', 'working_dir': None}
+    shared_assigned = {'001|q2': [hit('001|q2', 9606, "P2 Kinase B OS=Homo sapiens OX=9606")]}
+
+    shared_steps.merge_run(run, shared_assigned, [])
+
+    with open(run_dir / "query_brownamed.fasta") as f:
+        headers = [line.strip() for line in f if line.startswith(">")]
+    assert headers == [">q1 Kinase A FROM Mus musculus", ">q2 Kinase B FROM Homo sapiens"]
+    with open(run_dir / "query_diamond_results.tsv") as f:
+        rows = [line.rstrip("\n").split("\t") for line in f]
+    assert "Homo sapiens" in rows[2] and "Mus musculus" in rows[1]
+    assert run['merged']
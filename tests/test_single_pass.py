@@ -0,0 +1,139 @@
+import os
+import random
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import homology
+import utils
+
+# Parity of the single-pass selection (homology.select_best_by_step) with the
+# iterative loop: for every step, the hits DIAMOND would return for the taxon
+# list of that step, selected with select_best_by_priority.
+
+# taxid: parent. Target species 40, lineage 40 > 30 > 20 > 10 > 131567
+TAXONOMY = {
+    1: 1, 131567: 1, 10: 131567,
+    20: 10, 21: 10,
+    30: 20, 31: 20,
+    40: 30, 41: 30, 42: 30, 45: 41,
+    43: 31, 44: 31,
+    50: 21,
+}
+RANKS = {1: 'no rank', 131567: 'no rank', 10: 'kingdom', 20: 'family', 21: 'family', 30: 'genus', 31: 'genus'}
+TARGET = 40
+# Subjects annotated directly on lineage nodes with children (30, 20, 10), on
+# the ancestor of an --ex-tax clade (31), outside the lineage (1) or without taxid
+SUBJECT_TAXA = [40, 41, 42, 45, 30, 31, 43, 44, 20, 21, 50, 10, 131567, 1, None]
+QUERIES = ["q1", "q2", "q3", "q4", "q5"]
+
+
+@pytest.fixture(autouse=True)
+def taxonomy():
+    saved = utils.PARENT, utils.CHILDREN, utils.TAXID_TO_DBSIZE
+    children = {}
+    for taxid, parent in TAXONOMY.items():
+        children.setdefault(str(parent), []).append(taxid)
+    counts = {}
+    for taxid in SUBJECT_TAXA:
+        # One sequence per annotated taxon, counted in every ancestor
+        while taxid is not None:
+            counts[taxid] = counts.get(taxid, 0) + 1
+            parent = TAXONOMY[taxid]
+            taxid = None if parent == taxid else parent
+    utils.PARENT = {str(taxid): parent for taxid, parent in TAXONOMY.items()}
+    utils.CHILDREN = children
+    utils.TAXID_TO_DBSIZE = {str(taxid): {'total': n, 'swissprot': n} for taxid, n in counts.items()}
+    utils.SUBTREES.clear()
+    yield
+    utils.PARENT, utils.CHILDREN, utils.TAXID_TO_DBSIZE = saved
+    utils.SUBTREES.clear()
+
+
+def hit_stream(seed, n_hits=400):
+    # Few distinct scores, so that ties are broken by the arrival order
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n_hits):
+        rows.append((
+            rng.choice(QUERIES), f"sp|S{i}|S{i}_X", rng.choice([90.0, 75.0, 75.0, 60.0]), 80.0,
+            rng.choice([50, 100, 150]), 1e-20, rng.choice([40.0, 60.0, 80.0, 80.0, 120.0]),
+            150, rng.choice([150, 300]), rng.choice(SUBJECT_TAXA), f"S{i} Protein {i} OS=X OX=1"
+        ))
+    return rows
+
+def parse(rows, group, excluded_tax):
+    # Through the DIAMOND output parser, as in run_diamond: fresh hits for every
+    # selection, without the subjects of the --ex-tax subtrees
+    lines = ["\t".join("" if value is None else str(value) for value in row) + "\n" for row in rows]
+    return homology.parse_diamond_tsv(lines, group, excluded_tax)
+
+def lineage_groups(last_tax=None):
+    return [(tax, f"taxon {tax}", RANKS.get(tax, 'species')) for tax in utils.get_lineage(TARGET, last_tax)]
+
+def iterative_steps(rows, ex_tax=None, last_tax=None):
+    # Hits of each step as DIAMOND returns them with --taxonlist
+    excluded_tax = utils.excluded_taxa(ex_tax)
+    result = {}
+    prev_group = None
+    for step, group in enumerate(lineage_groups(last_tax), start=1):
+        curr_tax = group[0]
+        taxon_list = homology.build_taxon_list(curr_tax, prev_group, ex_tax=ex_tax)
+        prev_group = curr_tax
+        if not taxon_list:
+            continue
+        allowed = set().union(*(utils.get_children(taxid) for taxid in taxon_list))
+        step_rows = [row for row in rows if row[9] in allowed]
+        best = homology.select_best_by_priority(parse(step_rows, group, excluded_tax), TARGET, step)
+        if best:
+            result[step] = best
+    return result
+
+def single_pass_steps(rows, ex_tax=None, last_tax=None):
+    # One search over the widest taxon of the lineage
+    excluded_tax = utils.excluded_taxa(ex_tax)
+    groups = lineage_groups(last_tax)
+    return homology.select_best_by_step(parse(rows, groups[-1], excluded_tax), groups, excluded_tax)
+
+def summary(best_by_step):
+    return {
+        step: {q: [(h.sseqid, h.staxid, h.bits, h.pident, h.key, h.ancestor) for h in hits] for q, hits in best.items()}
+        for step, best in best_by_step.items()
+    }
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_parity(seed):
+    rows = hit_stream(seed)
+    assert summary(single_pass_steps(rows)) == summary(iterative_steps(rows))
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("ex_tax", [[44], [31], [41], [30]])
+def test_parity_with_ex_tax(seed, ex_tax):
+    rows = hit_stream(seed)
+    assert summary(single_pass_steps(rows, ex_tax)) == summary(iterative_steps(rows, ex_tax))
+
+def test_parity_with_last_tax():
+    rows = hit_stream(0)
+    assert summary(single_pass_steps(rows, last_tax=20)) == summary(iterative_steps(rows, last_tax=20))
+
+def test_subject_on_lineage_node_with_children():
+    # Never in the taxon list of any step: only the children of each node are listed
+    rows = [
+        ("q1", "sp|A|A_X", 90.0, 80.0, 150, 1e-50, 200.0, 150, 150, 30, "A OS=X OX=30"),
+        ("q1", "sp|B|B_X", 80.0, 80.0, 150, 1e-40, 100.0, 150, 150, 42, "B OS=X OX=42"),
+    ]
+    best = single_pass_steps(rows)
+    assert summary(best) == summary(iterative_steps(rows))
+    assert [h.sseqid for h in best[2]["q1"]] == ["sp|B|B_X"]
+
+def test_subject_on_ex_tax_ancestor():
+    # 31 holds sequences of its own, so it stays in the list of step 3 and the
+    # hits of the excluded species 44 are filtered after the search
+    rows = [
+        ("q1", "sp|A|A_X", 90.0, 80.0, 150, 1e-50, 200.0, 150, 150, 44, "A OS=X OX=44"),
+        ("q1", "sp|B|B_X", 80.0, 80.0, 150, 1e-40, 100.0, 150, 150, 31, "B OS=X OX=31"),
+    ]
+    assert 31 in homology.build_taxon_list(20, 30, ex_tax=[44])
+    best = single_pass_steps(rows, [44])
+    assert summary(best) == summary(iterative_steps(rows, [44]))
+    assert [h.sseqid for h in best[3]["q1"]] == ["sp|B|B_X"]
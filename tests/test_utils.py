@@ -0,0 +1,48 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pytest
+import utils
+
+
+def test_corrected_eta_counts_searched_steps_only():
+    stats_data = {
+        # Empty taxon list: predicted but never searched
+        'Step 1': {'estimated_runtime': '10.00', 'elapsed_time': '0.01'},
+        'Step 2': {'estimated_runtime': '4.00', 'elapsed_time': '8.01', 'search_time': '6.00'},
+        # Fully answered from the hit cache
+        'Step 3': {'estimated_runtime': '6.00', 'elapsed_time': '8.02'},
+        'Step 4': {'estimated_runtime': '2.00', 'elapsed_time': '11.00', 'search_time': '3.00'},
+    }
+    ratio, remaining = utils.corrected_eta(stats_data, [10.0, 4.0, 6.0, 2.0, 8.0, 12.0], 4)
+    assert ratio == pytest.approx(1.5)
+    assert remaining == pytest.approx(30.0)
+
+def test_corrected_eta_without_searched_step():
+    ratio, remaining = utils.corrected_eta({'Step 1': {'estimated_runtime': '10.00'}}, [10.0, 5.0], 1)
+    assert ratio == 1.0
+    assert remaining == 5.0
+
+
+DB_SEQUENCES = 250_000_000
+
+@pytest.mark.parametrize("available, residues, expected", [
+    # Enough memory: a single index chunk, the block as large as it fits
+    (128e9, 0, (8.5, 1)),
+    # The first chunk count that fits a 2 GB block
+    (16e9, 0, (2.1, 4)),
+    # The query sequences take their share of the memory first
+    (16e9, 100_000_000, (2.1, 8)),
+    # Not even with 16 chunks: the largest block that fits
+    (4e9, 0, (0.6, 16)),
+])
+def test_diamond_memory_settings(available, residues, expected):
+    assert utils.diamond_memory_settings(DB_SEQUENCES, residues, threads=8, available=available) == expected
+
+def test_diamond_memory_settings_small_database():
+    # No block larger than the searched sequences
+    assert utils.diamond_memory_settings(1000, 0, threads=8, available=128e9) == (0.1, 1)
+
+def test_diamond_memory_settings_unknown_memory(monkeypatch):
+    monkeypatch.setattr(utils, "available_memory", lambda: None)
+    assert utils.diamond_memory_settings(DB_SEQUENCES, 0, threads=8) == (None, None)
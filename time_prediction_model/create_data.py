@@ -1,70 +1,62 @@
 import os
 import sys
-import pandas as pd
+import json
 import glob
+import pandas as pd
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import utils
 
-def read_log(file_path):
-    log_data = {}
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-        step = None
-        for line in lines:
+# One row per DIAMOND step, read from the metrics.jsonl written by main.py in
+# every run directory. Older runs only have their log, which lacks the residues,
+# threads and mode of each step, so they are not used.
+COLUMNS = ['nb_query', 'residues', 'dbsize', 'threads', 'sensitivity', 'swissprot_only', 'time']
+
+def read_metrics(file_path):
+    rows = []
+    with open(file_path, 'r') as f:
+        for line in f:
             line = line.strip()
-            if line.startswith("[INFO] Step") and "Searching among" in line:\n                step = line.split(":")[0].replace("[INFO] ", "")
-                log_data[step] = {}
-                
-                if "pending sequences" in line:
-                    parts = line.split("with")
-                    dbsize = parts[0].split("among")[1].strip().split(" ")[0]
-                    nb_query = parts[1].split("pending sequences")[0].strip()
-                    log_data[step]['nb_query'] = int(nb_query)
-                    log_data[step]['dbsize'] = int(dbsize)
-                
-            elif step and line.startswith("[INFO] Elapsed time:"):
-                elapsed_time = line.split(":")[1].strip().split(" ")[0]
-                log_data[step]['elapsed_time'] = float(elapsed_time)
-    return log_data
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of a run killed while writing
+                continue
+            if record.get('step', 0) < 1:
+                # Single-pass search, run with many more targets per query
+                continue
+            rows.append({
+                'nb_query': record['nb_query'],
+                'residues': record['residues'],
+                'dbsize': record['dbsize'],
+                'threads': record['threads'],
+                'sensitivity': utils.mode_sensitivity(record.get('mode', 'more-sensitive')),
+                'swissprot_only': int(bool(record.get('swissprot_only', False))),
+                'time': record['time']
+            })
+    return rows
 
-# Find all .log files in ../runs/*/
-log_files = []
+metrics_files = []
 runs_dir = '../runs'
 if os.path.exists(runs_dir):
-    for log_path in glob.glob(os.path.join(runs_dir, '*', '*.log')):
-        log_files.append(log_path)
-        print(f"Found: {log_path}")
+    for metrics_path in glob.glob(os.path.join(runs_dir, '*', 'metrics.jsonl')):
+        metrics_files.append(metrics_path)
+        print(f"Found: {metrics_path}")
 else:
     print(f"Warning: {runs_dir} directory not found")
 
-if not log_files:
-    print("No log files found. Run some Brownaming analyses first!")
+if not metrics_files:
+    print("No metrics.jsonl found. Run some Brownaming analyses first!")
     sys.exit(1)
 
-data_file_data = {
-    'nb_query': [],
-    'dbsize': [],
-    'time': []
-}
-
-print(f"\\nProcessing {len(log_files)} log files...")
-for log_file in log_files:
-    log_data = read_log(log_file)
-    last_elapsed_time = 0.0
-    for step in log_data:
-        if step.startswith("Step"):
-            nb_query = log_data[step]['nb_query'] if 'nb_query' in log_data[step] else None
-            dbsize = log_data[step]['dbsize'] if 'dbsize' in log_data[step] else None
-            elapsed_time = log_data[step]['elapsed_time'] if 'elapsed_time' in log_data[step] else None
-            if nb_query and dbsize and elapsed_time:
-                runtime = round(float(elapsed_time) - float(last_elapsed_time), 2)
-                data_file_data['nb_query'].append(nb_query)
-                data_file_data['dbsize'].append(dbsize)
-                data_file_data['time'].append(runtime)
-                last_elapsed_time = elapsed_time
+rows = []
+print(f"\nProcessing {len(metrics_files)} metrics files...")
+for metrics_file in metrics_files:
+    rows.extend(read_metrics(metrics_file))
 
-    
-df = pd.DataFrame(data_file_data)
+df = pd.DataFrame(rows, columns=COLUMNS)
 df.to_csv('data_file.tsv', sep='\t', index=False)
-print(f"\\nDataset created with {len(df)} entries")
+print(f"\nDataset created with {len(df)} entries")
 print(f"Saved to: data_file.tsv")
-print("\\nYou can now train the model with: python train_model.py")
\ No newline at end of file
+print("\nYou can now train the model with: python train_model.py")
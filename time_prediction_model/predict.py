@@ -1,15 +1,10 @@
-import pandas as pd
-import pickle
 import os
-from sklearn.linear_model import LinearRegression
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import utils
 
-def predict_diamond_time(nb_query, dbsize, model_path='../diamond_time_model.pkl'):
-    with open(model_path, 'rb') as f:
-        model = pickle.load(f)
-
-    features = pd.DataFrame([[nb_query, dbsize]], columns=['nb_query', 'dbsize'])    
-    predicted_time = model.predict(features)[0]
-    return predicted_time
+def predict_diamond_time(nb_query, dbsize, residues=None, threads=None, mode="more-sensitive", swissprot_only=False):
+    return float(utils.predict_diamond_time(nb_query, dbsize, residues=residues, threads=threads, mode=mode, swissprot_only=swissprot_only))
 
 if __name__ == "__main__":
     test_data = [
@@ -25,4 +20,3 @@ if __name__ == "__main__":
         nb_query, db_size = test
         time_estimate = predict_diamond_time(nb_query, db_size)
         print(f"{nb_query} queries against a DB with {db_size} entries -> Estimated time: {time_estimate:.2f} minutes")
-        
\ No newline at end of file
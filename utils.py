@@ -1,12 +1,13 @@
+import gzip
+import hashlib
+import heapq
 import json
 import os
 import re
-from Bio import SeqIO
-import numpy as np
 import pickle
-import requests
+import struct
+import zlib
 import time
-import pandas as pd
 import logging
 
 LOCAL_DB_PATH = None
@@ -15,6 +16,20 @@ RANK = {}
 CHILDREN = {}
 TAXID_TO_NAME = {}
 TAXID_TO_DBSIZE = {}
+CLADE_DBS = None
+SUBTREES = {}
+TIME_MODEL = None
+TIME_MODEL_LOG_FEATURES = ('nb_query', 'residues', 'dbsize', 'threads')
+AVERAGE_PROTEIN_LENGTH = 350
+DIAMOND_MEMORY_FRACTION = 0.8
+DIAMOND_GB_PER_THREAD = 0.05
+DIAMOND_INDEX_CHUNKS = (1, 2, 4, 8, 16)
+QUERY_BYTES_PER_RESIDUE = 20
+# UniProt titles: "ACC Description OS=Species OX=taxid GN=gene ..."
+DESCRIPTION_RE = re.compile(r" (.*) OS=")
+GENE_NAME_RE = re.compile(r" GN=([^ ]+)")
+# DIAMOND modes, from the fastest to the most sensitive
+SENSITIVITY = {'fast': 0, 'mid-sensitive': 1, 'sensitive': 2, 'more-sensitive': 3, 'very-sensitive': 4, 'ultra-sensitive': 5}
 
 
 def create_run(run_id):
@@ -51,6 +66,38 @@ def setup_logger(run_id):
     
     return logger
 
+def output_files(query_fasta, directory):
+    basename = os.path.basename(query_fasta)
+    output_fasta_file = directory + '/' + basename.replace('.fasta', '_brownamed.fasta').replace('.faa', '_brownamed.fasta')
+    output_stats_file = directory + '/' + basename.replace('.fasta', '_brownaming_stats.png').replace('.faa', '_brownaming_stats.png')
+    output_excel_file = directory + '/' + basename.replace('.fasta', '_diamond_results.xlsx').replace('.faa', '_diamond_results.xlsx')
+    return output_fasta_file, output_stats_file, output_excel_file
+
+def write_brownamed_fasta(query_fasta, assigned, output_fasta_file, compress=False):
+    # Streams the query FASTA: headers are rewritten one by one, sequence lines
+    # are copied as they are. With compress, writes output_fasta_file + '.gz'
+    taxid2name = get_taxid_to_scientificname() or {}
+    if compress:
+        output_fasta_file += '.gz'
+    building = output_fasta_file + '.building'
+    out = gzip.open(building, 'wb', compresslevel=6) if compress else open(building, 'wb')
+    with open(query_fasta, 'rb') as in_f, out:
+        for line in in_f:
+            if line.startswith(b'>'):
+                fields = line[1:].split(None, 1)
+                qid = fields[0].decode() if fields else ''
+                line = f">{qid} {brownamed_description(assigned.get(qid), taxid2name)}\n".encode()
+            out.write(line)
+    os.replace(building, output_fasta_file)
+    return output_fasta_file
+
+def brownamed_description(hits, taxid2name):
+    if hits:
+        match = DESCRIPTION_RE.search(hits[0].stitle)
+        if match:
+            return f"{match.group(1)} FROM {taxid2name.get(str(hits[0].staxid), '')}"
+    return "Uncharacterized protein"
+
 def script_dir():
     return os.path.dirname(os.path.abspath(__file__))
 
@@ -69,7 +116,14 @@ def set_local_db_path():
 def get_parent_dict():
     return PARENT
 
+def taxonomy_dir():
+    return os.path.join(LOCAL_DB_PATH, "taxonomy")
+
 def set_parent_dict():
+    import taxonomy
+    store = taxonomy.open_parent(taxonomy_dir())
+    if store is not None:
+        return store
     parent_path = os.path.join(LOCAL_DB_PATH, "taxonomy", "parent.json")
     if os.path.exists(parent_path):
         with open(parent_path, 'r') as f:
@@ -79,6 +133,10 @@ def get_rank_dict():
     return RANK
 
 def set_rank_dict():
+    import taxonomy
+    store = taxonomy.open_rank(taxonomy_dir())
+    if store is not None:
+        return store
     rank_path = os.path.join(LOCAL_DB_PATH, "taxonomy", "rank.json")
     if os.path.exists(rank_path):
         with open(rank_path, 'r') as f:
@@ -88,6 +146,11 @@ def get_children_dict():
     return CHILDREN
 
 def set_children_dict():
+    import taxonomy
+    SUBTREES.clear()
+    store = taxonomy.open_children(taxonomy_dir())
+    if store is not None:
+        return store
     children_path = os.path.join(LOCAL_DB_PATH, "taxonomy", "children.json")
     if os.path.exists(children_path):
         with open(children_path, 'r') as f:
@@ -97,6 +160,10 @@ def get_taxid_to_scientificname():
     return TAXID_TO_NAME
 
 def set_taxid_to_scientificname():
+    import taxonomy
+    store = taxonomy.open_names(taxonomy_dir())
+    if store is not None:
+        return store
     taxid2name_path = os.path.join(LOCAL_DB_PATH, "taxonomy", "taxid2scientific_name.json")
     if os.path.exists(taxid2name_path):
         with open(taxid2name_path, 'r') as f:
@@ -106,6 +173,10 @@ def get_taxid_to_dbsize():
     return TAXID_TO_DBSIZE
 
 def set_taxid_to_dbsize():
+    import taxonomy
+    store = taxonomy.open_dbsize(taxonomy_dir())
+    if store is not None:
+        return store
     taxid2dbsize_path = os.path.join(LOCAL_DB_PATH, "taxonomy", "taxid2dbsize.json")
     if os.path.exists(taxid2dbsize_path):
         with open(taxid2dbsize_path, 'r') as f:
@@ -116,60 +187,218 @@ def get_db_dmnd(swissprot_only):
         return os.path.join(LOCAL_DB_PATH, "diamond", "uniprot_sprot.dmnd")
     return os.path.join(LOCAL_DB_PATH, "diamond", "uniprot_all.dmnd")
 
+def get_clade_dbs():
+    global CLADE_DBS
+    if CLADE_DBS is None:
+        CLADE_DBS = {}
+        manifest_path = os.path.join(LOCAL_DB_PATH, "diamond", "clades", "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                for taxid, info in json.load(f).items():
+                    dmnd = os.path.join(LOCAL_DB_PATH, "diamond", "clades", info["dmnd"])
+                    if os.path.exists(dmnd):
+                        CLADE_DBS[int(taxid)] = dict(info, dmnd=dmnd)
+    return CLADE_DBS
+
+def is_in_subtree(taxid, ancestor):
+    while taxid is not None:
+        if taxid == ancestor:
+            return True
+        parent = PARENT.get(str(taxid))
+        if parent == taxid:
+            return False
+        taxid = parent
+    return False
+
+def select_db(swissprot_only, taxonlist=None):
+    # Smallest pre-built clade database whose subtree holds every searched taxon.
+    # Returns the .dmnd path and the full database size in letters to keep
+    # e-values identical (None when searching the full database).
+    if swissprot_only or not taxonlist:
+        return get_db_dmnd(swissprot_only), None
+    covering = [
+        info for clade, info in get_clade_dbs().items()
+        if all(is_in_subtree(int(taxid), clade) for taxid in taxonlist)
+    ]
+    if not covering:
+        return get_db_dmnd(swissprot_only), None
+    best = min(covering, key=lambda info: info["sequences"])
+    return best["dmnd"], best.get("full_letters")
+
 def gene_name_from_stitle(stitle):
     # UniProt: look for " GN=gene_name "
-    match = re.search(r" GN=([^ ]+)", stitle)
+    match = GENE_NAME_RE.search(stitle)
     if match:
         return match.group(1).strip()
     return ""
 
 def get_children(taxid):
-    all_children = {taxid}
-    stack = [taxid]
-    while stack:
-        current = str(stack.pop())
-        if current in CHILDREN:
-            for child in CHILDREN[current]:
-                if child not in all_children:
-                    all_children.add(child)
-                    stack.append(child)
-    return all_children
-
-def write_pending_fasta(src_faa, pending_ids, out_path):
-    n = 0
-    with open(out_path, 'w') as out_f:
-        for rec in SeqIO.parse(src_faa, 'fasta'):
-            if rec.id in pending_ids:
-                SeqIO.write(rec, out_f, 'fasta')
-                n += 1
-    return n
-
-
-def estimate_runtime(nb_query, target_taxid, last_tax=None, swissprot_only=False):
+    # Whole subtree of taxid (itself included), memoized until the taxonomy is reloaded
+    if taxid not in SUBTREES:
+        all_children = {taxid}
+        stack = [taxid]
+        while stack:
+            current = str(stack.pop())
+            if current in CHILDREN:
+                for child in CHILDREN[current]:
+                    if child not in all_children:
+                        all_children.add(child)
+                        stack.append(child)
+        SUBTREES[taxid] = frozenset(all_children)
+    return SUBTREES[taxid]
+
+def excluded_taxa(ex_tax):
+    # Set of every taxid excluded with --ex-tax, shared by run_diamond and the parser
+    excluded = set()
+    for tax in ex_tax or []:
+        excluded |= get_children(tax)
+    return frozenset(excluded)
+
+def get_lineage(target_taxid, last_tax=None):
+    lineage = []
+    curr_tax = target_taxid
+    while curr_tax:
+        lineage.append(curr_tax)
+        if curr_tax == last_tax or curr_tax == 131567: # 131567: cellular organisms
+            break
+        parent = PARENT.get(str(curr_tax))
+        if parent == curr_tax:
+            break
+        curr_tax = parent
+    return lineage
+
+FASTA_INDEX_VERSION = 2
+
+def fasta_signature(fasta_path):
+    st = os.stat(fasta_path)
+    return f"v{FASTA_INDEX_VERSION}\t{os.path.abspath(fasta_path)}\t{st.st_size}\t{st.st_mtime_ns}"
+
+def build_fasta_index(fasta_path):
+    # faidx-like index: (id, byte offset of the header, byte length of the record,
+    # residues, SHA-1 of the upper-case sequence)
+    index = []
+    with open(fasta_path, 'rb') as f:
+        offset = 0
+        qid = None
+        start = 0
+        residues = 0
+        digest = None
+        for line in f:
+            if line.startswith(b'>'):
+                if qid is not None:
+                    index.append((qid, start, offset - start, residues, digest.hexdigest()))
+                title = line[1:].split(None, 1)
+                qid = title[0].decode() if title else ""
+                start = offset
+                residues = 0
+                digest = hashlib.sha1()
+            elif qid is not None:
+                seq = line.strip()
+                residues += len(seq)
+                digest.update(seq.upper())
+            offset += len(line)
+        if qid is not None:
+            index.append((qid, start, offset - start, residues, digest.hexdigest()))
+    return index
+
+def save_fasta_index(index, fasta_path, index_path):
+    with open(index_path, 'w') as f:
+        f.write(f"#{fasta_signature(fasta_path)}\n")
+        for qid, offset, length, residues, seq_hash in index:
+            f.write(f"{qid}\t{offset}\t{length}\t{residues}\t{seq_hash}\n")
+
+def load_fasta_index(fasta_path, index_path):
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as f:
+        if f.readline().rstrip("\n") != f"#{fasta_signature(fasta_path)}":
+            return None
+        index = []
+        for line in f:
+            qid, offset, length, residues, seq_hash = line.rstrip("\n").split("\t")
+            index.append((qid, int(offset), int(length), int(residues), seq_hash))
+    return index
+
+def get_fasta_index(fasta_path, run_id):
+    index_path = os.path.join(working_dir(run_id), 'query.fai')
+    index = load_fasta_index(fasta_path, index_path)
+    if index is None:
+        index = build_fasta_index(fasta_path)
+        save_fasta_index(index, fasta_path, index_path)
+    return index
+
+def collapse_duplicates(ids, seq_hash):
+    # One representative per distinct sequence: {representative: [members]}
+    groups = {}
+    for qid in sorted(ids):
+        groups.setdefault(seq_hash[qid], []).append(qid)
+    return {members[0]: members for members in groups.values()}
+
+def balance_records(index, n_parts):
+    # Longest records first, each one to the part with the fewest residues so far
+    heap = [(0, i) for i in range(n_parts)]
+    parts = [[] for _ in range(n_parts)]
+    for entry in sorted(index, key=lambda e: e[3], reverse=True):
+        residues, i = heapq.heappop(heap)
+        parts[i].append(entry)
+        heapq.heappush(heap, (residues + entry[3], i))
+    return [sorted(records, key=lambda e: e[1]) for records in parts if records]
+
+def write_pending_fasta(src_faa, pending_ids, out_path, index):
+    records = [entry for entry in index if entry[0] in pending_ids]
+    copy_fasta_records(src_faa, records, out_path)
+    return len(records)
+
+def copy_fasta_records(src_faa, records, out_path):
+    # Raw byte-range copy of indexed records, adjacent records are copied at once
+    ranges = []
+    for _, offset, length, _, _ in records:
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1][1] = offset + length
+        else:
+            ranges.append([offset, offset + length])
+    with open(src_faa, 'rb') as in_f, open(out_path, 'wb') as out_f:
+        for start, end in ranges:
+            in_f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = in_f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                out_f.write(chunk)
+                remaining -= len(chunk)
+
+
+def estimate_runtime(nb_query, target_taxid, last_tax=None, swissprot_only=False, residues=None, threads=None, mode="more-sensitive"):
+    import numpy as np
     predicted_times = []
     dbsizes = []
-    curr_tax = target_taxid
-    prev_group = None
     sum_previous_dbsize = 0
-    while curr_tax:
-        dbsize_count = count_sequence_from_taxid(curr_tax)
-        current_dbsize = dbsize_count['swissprot' if swissprot_only else 'total']
+    for curr_tax in get_lineage(target_taxid, last_tax):
+        dbsize_count = get_dbsize(curr_tax)
+        current_dbsize = dbsize_count.get('swissprot' if swissprot_only else 'total', 0)
         previous_dbsize = dbsizes[-1] if dbsizes else 0
         sum_previous_dbsize += previous_dbsize
         dbsizes.append(current_dbsize-sum_previous_dbsize)        
-        
-        predicted_time = predict_diamond_time(nb_query, dbsizes[-1])
-        predicted_times.append(max(0.0, predicted_time))
-        
-        prev_group = curr_tax
-        if curr_tax == last_tax or curr_tax == 131567: # 131567: cellular organisms
-            curr_tax = None
-        else:
-            curr_tax = PARENT.get(str(curr_tax))
+
+    if dbsizes:
+        predicted = predict_diamond_time(
+            np.full(len(dbsizes), nb_query), np.array(dbsizes),
+            residues=residues, threads=threads, mode=mode, swissprot_only=swissprot_only
+        )
+        predicted_times = np.maximum(predicted, 0.0).tolist()
     
     return sum(predicted_times), predicted_times, dbsizes
 
+def get_dbsize(taxid):
+    # Local subtree counts built with the database, the UniProt REST API is only
+    # queried when the index is missing (databases built by older versions)
+    if TAXID_TO_DBSIZE:
+        return TAXID_TO_DBSIZE.get(str(taxid), {"swissprot": 0, "total": 0})
+    return count_sequence_from_taxid(taxid)
+
 def count_sequence_from_taxid(taxid):
+    import requests
     url = f"https://rest.uniprot.org/taxonomy/search?query=(tax_id:{taxid})&format=json&fields=statistics"
 
     response = requests.get(url)
@@ -185,19 +414,164 @@ def count_sequence_from_taxid(taxid):
             }
     return {}
 
-def predict_diamond_time(nb_query, dbsize):
-    model_path = os.path.join(script_dir(), 'diamond_time_model.pkl')
-    if not os.path.exists(model_path):
+def read_first_int(path):
+    try:
+        with open(path, 'r') as f:
+            value = f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+    return int(value) if value.isdigit() else None
+
+def available_memory():
+    # Bytes this process can still use: MemAvailable, bounded by the cgroup
+    # limit (v2, then v1) so that Docker and Slurm limits are respected
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    for limit_file, usage_file in (
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')
+    ):
+        limit = read_first_int(limit_file)
+        # "max" in v2, a value close to 2^63 in v1 when unlimited
+        if limit is None or limit >= 1 << 60:
+            continue
+        free = limit - (read_first_int(usage_file) or 0)
+        available = free if available is None else min(available, free)
+        break
+    return available
+
+def diamond_memory_settings(dbsize, residues, threads=None, available=None):
+    # DIAMOND uses about block_size * (4 + 8 / index_chunks) GB (6x the block
+    # size with its default 4 chunks). Fewer chunks are faster but need more
+    # memory, and a block larger than the searched sequences is useless.
+    if available is None:
+        available = available_memory()
+    if not available:
+        return None, None
+    threads = threads or os.cpu_count() or 1
+    usable_gb = (available * DIAMOND_MEMORY_FRACTION - residues * QUERY_BYTES_PER_RESIDUE) / 1e9 - DIAMOND_GB_PER_THREAD * threads
+    needed = max(0.1, dbsize * AVERAGE_PROTEIN_LENGTH / 1e9)
+    for chunks in DIAMOND_INDEX_CHUNKS:
+        block_size = usable_gb / (4 + 8 / chunks)
+        if block_size >= min(needed, 2.0):
+            break
+    block_size = max(0.1, min(block_size, needed))
+    return round(block_size, 1), chunks
+
+def load_time_model():
+    # Model coefficients, loaded once per process. The JSON export written by
+    # train_model.py avoids importing scikit-learn; the pickled model is only
+    # unpickled when no export exists (older installs, nb_query and dbsize only).
+    import numpy as np
+    global TIME_MODEL
+    if TIME_MODEL is None:
+        TIME_MODEL = False
+        json_path = os.path.join(script_dir(), 'diamond_time_model.json')
+        model_path = os.path.join(script_dir(), 'diamond_time_model.pkl')
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as f:
+                model = json.load(f)
+            TIME_MODEL = {
+                'type': model.get('type', 'linear'),
+                'features': model.get('features', ['nb_query', 'dbsize']),
+                'intercept': float(model['intercept']),
+                'coef': np.array(model['coef'], dtype=float)
+            }
+        elif os.path.exists(model_path):
+            with open(model_path, 'rb') as f:
+                model = pickle.load(f)
+            if len(model.coef_) == 2:
+                TIME_MODEL = {
+                    'type': 'linear',
+                    'features': ['nb_query', 'dbsize'],
+                    'intercept': float(model.intercept_),
+                    'coef': np.asarray(model.coef_, dtype=float)
+                }
+    return TIME_MODEL
+
+def mode_sensitivity(mode):
+    # A cascade runs its fast mode on every query and --more-sensitive on the rest
+    if mode.startswith("cascade:"):
+        return (mode_sensitivity(mode.split(":", 1)[1]) + SENSITIVITY['more-sensitive']) / 2
+    return SENSITIVITY.get(mode, SENSITIVITY['more-sensitive'])
+
+def time_model_matrix(features, names, log=True):
+    # Shared by the training script and the predictions: counts are modelled in log space
+    import numpy as np
+    columns = []
+    for name in names:
+        values = np.asarray(features[name], dtype=float)
+        columns.append(np.log1p(values) if log and name in TIME_MODEL_LOG_FEATURES else values)
+    return np.column_stack(columns)
+
+def predict_diamond_time(nb_query, dbsize, residues=None, threads=None, mode="more-sensitive", swissprot_only=False):
+    # Accepts scalars or arrays (one value per step) and predicts them in one call
+    import numpy as np
+    nb_query = np.asarray(nb_query, dtype=float)
+    dbsize = np.asarray(dbsize, dtype=float)
+    model = load_time_model()
+    if not model:
         # Model is optional - if not found, return a default estimate
         # Simple heuristic: ~0.1 second per query per 100k sequences in DB
         return (nb_query * dbsize / 100000) / 60  # Convert to minutes
-    
-    with open(model_path, 'rb') as f:
-        model = pickle.load(f)
-    
-    features = pd.DataFrame([[nb_query, dbsize]], columns=['nb_query', 'dbsize'])    
-    predicted_time = model.predict(features)[0]
-    return predicted_time
+
+    if residues is None:
+        residues = nb_query * AVERAGE_PROTEIN_LENGTH
+    nb_query, dbsize, residues = np.broadcast_arrays(nb_query, dbsize, np.asarray(residues, dtype=float))
+    features = {
+        'nb_query': nb_query,
+        'dbsize': dbsize,
+        'residues': residues,
+        'threads': np.full(nb_query.shape, threads or os.cpu_count() or 1, dtype=float),
+        'sensitivity': np.full(nb_query.shape, mode_sensitivity(mode), dtype=float),
+        'swissprot_only': np.full(nb_query.shape, float(bool(swissprot_only)))
+    }
+    X = time_model_matrix(features, model['features'], log=model['type'] == 'log-linear')
+    predicted = model['intercept'] + X @ model['coef']
+    if model['type'] == 'log-linear':
+        predicted = np.expm1(predicted)
+    return predicted.reshape(nb_query.shape)
+
+def corrected_eta(stats_data, estimated_runtime_list, step):
+    # Ratio of the observed time to the time predicted for the completed steps,
+    # applied to the predictions of the remaining steps. Only steps that ran a
+    # search count (not those with an empty taxon list or fully cached), and
+    # their search_time excludes the wait for cores in batch mode.
+    searched = [data for data in stats_data.values() if 'search_time' in data]
+    predicted = sum(float(data.get('estimated_runtime', 0)) for data in searched)
+    observed = sum(float(data['search_time']) for data in searched)
+    ratio = observed / predicted if predicted > 0 else 1.0
+    return ratio, ratio * sum(estimated_runtime_list[step:])
+
+def metrics_record(run_id, step, taxon_id, searched_ids, seq_residues, dbsize, threads, mode, swissprot_only, seconds, diamond_metrics):
+    # One line of metrics.jsonl: what was searched, how long the step took
+    # (minutes, as predicted by the time model, without the time spent waiting
+    # for cores in batch mode) and the DIAMOND measurements
+    record = {
+        'run_id': run_id,
+        'step': step,
+        'taxon_id': taxon_id,
+        'nb_query': len(searched_ids),
+        'residues': sum(seq_residues[q] for q in searched_ids),
+        'dbsize': dbsize,
+        'threads': threads or os.cpu_count() or 1,
+        'mode': mode,
+        'swissprot_only': bool(swissprot_only),
+        'time': (seconds - diamond_metrics.get('core_wait', 0.0)) / 60
+    }
+    record.update(diamond_metrics)
+    return record
+
+def append_metrics(run_id, record):
+    with open(os.path.join(working_dir(run_id), 'metrics.jsonl'), 'a') as f:
+        f.write(json.dumps(record) + "\n")
 
 def save_state_args(args, run_id):
     args_dict = vars(args)
@@ -205,38 +579,164 @@ def save_state_args(args, run_id):
     with open(args_path, 'w') as f:
         json.dump(args_dict, f, indent=4)
 
-def save_state(state_file, assigned, pending, curr_tax, prev_group, step, stats_data, elapsed, query_fasta, target_taxid, query_ids, estimated_runtime_list, dbsizes, args):
-    for step_key, step_data in list(stats_data.items()):
-        if 'elapsed_time' not in step_data:
-            stats_data.pop(step_key)
-    state = {
-        'assigned': assigned,
-        'pending': pending,
-        'curr_tax': curr_tax,
-        'prev_group': prev_group,
-        'step': step,
-        'stats_data': stats_data,
-        'elapsed': elapsed,
-        'timer_start': time.time() - elapsed,
+# Checkpoint journal: a header frame written when the run starts, then one
+# frame per completed step holding only what the step added. Frames are
+# appended and fsync'd; a frame cut by a kill fails its length or CRC check and
+# is dropped on replay, so the last complete step is always the resume point.
+JOURNAL_FILE = 'state.journal'
+JOURNAL_VERSION = 1
+JOURNAL_FRAME = struct.Struct('<IIB')  # payload length, CRC-32, flags
+JOURNAL_COMPRESSED = 1
+
+def journal_path(run_id):
+    return os.path.join(working_dir(run_id), JOURNAL_FILE)
+
+def append_journal(path, record, compress=False):
+    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 6)
+        flags |= JOURNAL_COMPRESSED
+    with open(path, 'ab') as f:
+        f.write(JOURNAL_FRAME.pack(len(payload), zlib.crc32(payload), flags) + payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+def reset_run_state(run_id):
+    # Checkpoints left by a previous run with the same ID (journal, legacy state.pkl)
+    removed = False
+    for name in (JOURNAL_FILE, 'state.pkl'):
+        path = os.path.join(working_dir(run_id), name)
+        if os.path.exists(path):
+            os.remove(path)
+            removed = True
+    return removed
+
+def start_journal(path, record, compress=False):
+    # New journal holding only the header, swapped in atomically: a fresh run
+    # that reuses a run ID must not replay the frames of the previous run
+    building = path + '.building'
+    if os.path.exists(building):
+        os.remove(building)
+    append_journal(building, record, compress)
+    os.replace(building, path)
+
+def read_journal(path, repair=False):
+    records = []
+    valid_end = 0
+    with open(path, 'rb') as f:
+        data = f.read()
+    while valid_end + JOURNAL_FRAME.size <= len(data):
+        length, crc, flags = JOURNAL_FRAME.unpack_from(data, valid_end)
+        start = valid_end + JOURNAL_FRAME.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        if flags & JOURNAL_COMPRESSED:
+            payload = zlib.decompress(payload)
+        records.append(pickle.loads(payload))
+        valid_end = start + length
+    if valid_end < len(data):
+        print(f"[WARNING] Incomplete checkpoint frame dropped ({len(data) - valid_end} bytes)", flush=True)
+        if repair:
+            # Later frames must follow the last complete one
+            with open(path, 'r+b') as f:
+                f.truncate(valid_end)
+    return records
+
+def journal_header(query_fasta, target_taxid, query_ids, estimated_runtime_list, dbsizes, curr_tax, prev_group=None,
+                   step=0, assigned=None, pending=None, stats_data=None, elapsed=0.0):
+    # Runs resumed from a legacy state.pkl start their journal from that state
+    return {
+        'type': 'header',
+        'version': JOURNAL_VERSION,
         'query_fasta': query_fasta,
         'target_taxid': target_taxid,
         'query_ids': query_ids,
         'estimated_runtime_list': estimated_runtime_list,
         'dbsizes': dbsizes,
-        'args': args
+        'assigned': assigned or {},
+        'pending': pending,
+        'curr_tax': curr_tax,
+        'prev_group': prev_group,
+        'step': step,
+        'stats_data': stats_data or {},
+        'elapsed': elapsed
     }
-    with open(state_file, 'wb') as f:
-        pickle.dump(state, f)
-    print(f"[INFO] State saved at elapsed time: {elapsed/60:.2f} minutes", flush=True)
 
-def load_state(run_id):
+def journal_step(step, best, resolved, curr_tax, prev_group, step_stats, elapsed):
+    return {
+        'type': 'step',
+        'step': step,
+        'assigned': best,
+        'resolved': resolved,
+        'curr_tax': curr_tax,
+        'prev_group': prev_group,
+        'stats': step_stats,
+        'elapsed': elapsed
+    }
+
+def journal_chunk(step, mode, ids, best):
+    # One finished DIAMOND chunk of a step that is not complete yet
+    return {
+        'type': 'chunk',
+        'step': step,
+        'mode': mode,
+        'ids': ids,
+        'best': best
+    }
+
+def replay_journal(records):
+    header = records[0]
+    state = {
+        'assigned': dict(header['assigned']),
+        'pending': set(header['query_ids']) if header['pending'] is None else set(header['pending']),
+        'curr_tax': header['curr_tax'],
+        'prev_group': header['prev_group'],
+        'step': header['step'],
+        'stats_data': dict(header['stats_data']),
+        'elapsed': header['elapsed'],
+        'query_fasta': header['query_fasta'],
+        'target_taxid': header['target_taxid'],
+        'query_ids': header['query_ids'],
+        'estimated_runtime_list': header['estimated_runtime_list'],
+        'dbsizes': header['dbsizes'],
+        'partial_step': {}
+    }
+    for record in records[1:]:
+        if record['type'] == 'chunk' and record['step'] == state['step'] + 1:
+            done = state['partial_step'].setdefault(record['mode'], {'ids': set(), 'best': {}})
+            done['ids'] |= record['ids']
+            done['best'].update(record['best'])
+        if record['type'] != 'step':
+            continue
+        state['partial_step'] = {}
+        state['assigned'].update(record['assigned'])
+        state['pending'] -= record['resolved']
+        state['curr_tax'] = record['curr_tax']
+        state['prev_group'] = record['prev_group']
+        state['step'] = record['step']
+        state['stats_data'][f"Step {record['step']}"] = record['stats']
+        state['elapsed'] = record['elapsed']
+    state['timer_start'] = time.time() - state['elapsed']
+    return state
+
+def run_completed(state):
+    return bool(state) and (state['curr_tax'] is None or not state['pending'])
+
+def load_state(run_id, repair=False):
     try:
         state_args_file = os.path.join(working_dir(run_id), 'state_args.json')
         with open(state_args_file, 'r') as f:
             state_args = json.load(f)
 
         state_file = os.path.join(working_dir(run_id), 'state.pkl')
-        if os.path.exists(state_file):
+        records = read_journal(journal_path(run_id), repair) if os.path.exists(journal_path(run_id)) else []
+        if records:
+            state = replay_journal(records)
+            print(f"[INFO] Loaded state from elapsed time: {state['elapsed']/60:.2f} minutes", flush=True)
+        elif os.path.exists(state_file):
+            # Runs checkpointed by older versions
             with open(state_file, 'rb') as f:
                 state = pickle.load(f)
             print(f"[INFO] Loaded state from elapsed time: {state['elapsed']/60:.2f} minutes", flush=True)